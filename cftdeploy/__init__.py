@@ -1,5 +1,38 @@
-from .manifest import *
-from .stack import *
-from .template import *
 from ._version import __version__, __version_info__
-from .entry_points import cft_deploy, cft_get_resource, cft_validate, cft_upload, cft_generate_manifest, cft_validate_manifest, cft_get_events, cft_delete, cft_diff, cft_get_output
+
+import importlib
+
+# The modules below import boto3 and yaml, which take hundreds of milliseconds to load. Rather than importing them
+# with the package, each one is imported the first time one of its names is used (PEP 562).
+_lazy_modules = ['manifest', 'stack', 'template', 'orchestrator', 'clients', 'cache', 'index']
+
+_entry_points = ['cft_deploy', 'cft_deploy_many', 'cft_get_resource', 'cft_validate', 'cft_upload', 'cft_generate_manifest',
+                 'cft_validate_manifest', 'cft_get_events', 'cft_delete', 'cft_diff', 'cft_get_output', 'cft_purge_cache',
+                 'cft_find_stack', 'cft_drift', 'cft_preview']
+
+__all__ = ['__version__', '__version_info__',
+           'CFManifest', 'StackLookup', 'StackLookupException',
+           'CFStack', 'CFStackEventCursor', 'CFStackWatcher', 'CFStackMonitor', 'CFStackDriftMonitor', 'CFStackDoesNotExistError',
+           'ResourceGoodStatus', 'ResourceBadStatus', 'ResourceTempStatus', 'StackTempStatus', 'StackDoneStatus', 'StackGoodStatus',
+           'StackDriftableStatus', 'DriftDetectionDoneStatus', 'ChangeSetDoneStatus',
+           'CFTemplate', 'CFTemplateTooLargeError',
+           'CFDeployPlan', 'CFRegionalDeploy', 'CFAccountDeploy', 'CFDeployPlanError',
+           'ClientRegistry', 'get_client_registry', 'set_client_registry', 'assume_role', 'get_caller_account',
+           'DiskCache', 'StackCache', 'ValidationCache', 'purge_cache',
+           'CFStackIndex'] + _entry_points
+
+
+def __getattr__(name):
+    if name in _entry_points:
+        module = importlib.import_module('.entry_points', __name__)
+        return(getattr(module, name))
+    if not name.startswith('_'):
+        for module_name in _lazy_modules:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            if hasattr(module, name):
+                return(getattr(module, name))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return(sorted(list(globals()) + _entry_points))
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import logging
+logger = logging.getLogger('cft-deploy.cache')
+
+
+DEFAULT_CACHE_DIR = os.getenv('CFT_DEPLOY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cft-deploy'))
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+
+# Validation results are keyed on the template's content, so they can be kept much longer than stack data
+DEFAULT_VALIDATION_CACHE_TTL = 7 * 86400
+
+# The statuses list_stacks is asked to return: every live stack, leaving out the deleted (or deleting) ones
+ListStacksStatusFilter = ["CREATE_COMPLETE", "ROLLBACK_COMPLETE", "UPDATE_COMPLETE", "UPDATE_ROLLBACK_COMPLETE",
+                          "UPDATE_ROLLBACK_FAILED", "IMPORT_COMPLETE", "IMPORT_ROLLBACK_COMPLETE", "CREATE_IN_PROGRESS",
+                          "UPDATE_IN_PROGRESS", "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS", "UPDATE_ROLLBACK_IN_PROGRESS",
+                          "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS", "ROLLBACK_IN_PROGRESS", "ROLLBACK_FAILED"]
+
+# The parts of a describe_stacks response kept in the StackCache
+CachedStackKeys = ['StackId', 'StackName', 'StackStatus', 'CreationTime', 'LastUpdatedTime', 'Parameters', 'Outputs']
+
+
+class DiskCache(object):
+    """Class to represent a directory of cached JSON values.
+
+    Each key is stored in its own file, written atomically, so several processes can share the cache. Entries older
+    than ttl seconds are stale. Once there are more than max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(self, namespace, cache_dir=None, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        self.namespace = namespace
+        self.cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        self.path = os.path.join(self.cache_dir, namespace)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _file(self, key):
+        return(os.path.join(self.path, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json"))
+
+    def get_entry(self, key):
+        """Return the entry for key, a dict of key, value and stored_at (epoch seconds), or None if there is none."""
+        try:
+            with open(self._file(key), "r") as f:
+                entry = json.load(f)
+            # Touch the file so eviction drops the least recently used entries first
+            os.utime(self._file(key))
+            return(entry)
+        except (FileNotFoundError, ValueError):
+            return(None)
+
+    def is_fresh(self, entry):
+        """Return True if the entry was stored less than ttl seconds ago."""
+        return(entry is not None and time.time() - entry['stored_at'] < self.ttl)
+
+    def get(self, key):
+        """Return the value for key, or None if it isn't cached or is stale."""
+        entry = self.get_entry(key)
+        if self.is_fresh(entry):
+            return(entry['value'])
+        return(None)
+
+    def put(self, key, value):
+        """Store value (which must be serializable as json) under key."""
+        os.makedirs(self.path, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'key': key, 'value': value, 'stored_at': time.time()}, f, default=str)
+        os.replace(tmp, self._file(key))
+        self.evict()
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries beyond max_entries."""
+        try:
+            files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".json")]
+        except FileNotFoundError:
+            return
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda f: os.stat(f).st_mtime)
+        for f in files[:len(files) - self.max_entries]:
+            logger.debug(f"Evicting {f} from the {self.namespace} cache")
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    def purge(self):
+        """Remove every entry in this cache. Returns the number of entries removed."""
+        try:
+            count = len([f for f in os.listdir(self.path) if f.endswith(".json")])
+        except FileNotFoundError:
+            return(0)
+        shutil.rmtree(self.path, ignore_errors=True)
+        return(count)
+
+
+class StackCache(DiskCache):
+    """Class to cache the Parameters, Outputs and Resources of stacks on disk.
+
+    An entry is only used while the stack's StackId and LastUpdatedTime are unchanged. Entries younger than ttl are
+    trusted as is. Stale entries are revalidated against one (paginated) list_stacks call per region, which covers
+    every stack in the region at once.
+    """
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_MAX_ENTRIES, namespace="stacks"):
+        """Entries are keyed by region and stack name, so stacks of different accounts need their own namespace."""
+        super().__init__(namespace, cache_dir=cache_dir, ttl=ttl, max_entries=max_entries)
+        self.summaries = {}  # region -> {StackName: version} from list_stacks, fetched at most once per region
+        self.lock = threading.Lock()
+
+    @classmethod
+    def stack_version(cls, stack_data):
+        """Return the string identifying this version of a stack from describe_stacks or list_stacks data."""
+        return(f"{stack_data['StackId']}@{stack_data.get('LastUpdatedTime', stack_data.get('CreationTime'))}")
+
+    @classmethod
+    def key(cls, region, stack_name):
+        return(f"{region}/{stack_name}")
+
+    def get_stack_summaries(self, cf_client, region):
+        """Return a dict of StackName to stack version for every live stack in the region, from list_stacks."""
+        with self.lock:
+            if region not in self.summaries:
+                logger.debug(f"Revalidating the stack cache with list_stacks in {region}")
+                summaries = {}
+                for page in cf_client.get_paginator('list_stacks').paginate(StackStatusFilter=ListStacksStatusFilter):
+                    for s in page['StackSummaries']:
+                        summaries[s['StackName']] = self.stack_version(s)
+                self.summaries[region] = summaries
+            return(self.summaries[region])
+
+    def lookup(self, stack):
+        """Return the cached data for the CFStack if it is still valid, otherwise None."""
+        key = self.key(stack.region, stack.stack_name)
+        entry = self.get_entry(key)
+        if entry is None:
+            logger.debug(f"Stack cache miss for {key}")
+            return(None)
+        if self.is_fresh(entry):
+            logger.debug(f"Stack cache hit for {key}")
+            return(entry['value'])
+
+        summaries = self.get_stack_summaries(stack.cf_client, stack.region)
+        if summaries.get(stack.stack_name) == entry['value']['Version']:
+            logger.debug(f"Stack cache hit for {key} after revalidation")
+            self.put(key, entry['value'])
+            return(entry['value'])
+        logger.debug(f"Stack cache entry for {key} is out of date")
+        self.delete(key)
+        return(None)
+
+    def store(self, stack, resources=None):
+        """Cache the stack's data from its last get(). If resources is None, any cached resources of the same version are kept."""
+        key = self.key(stack.region, stack.stack_name)
+        value = {
+            'Version': self.stack_version(stack.stackData),
+            'StackData': {k: stack.stackData[k] for k in CachedStackKeys if k in stack.stackData},
+            'Resources': resources,
+        }
+        if resources is None:
+            entry = self.get_entry(key)
+            if entry is not None and entry['value']['Version'] == value['Version']:
+                value['Resources'] = entry['value']['Resources']
+        self.put(key, value)
+
+    def invalidate(self, region, stack_name):
+        """Drop the cached data of the stack, which is being deployed, so the next lookup fetches it from AWS."""
+        logger.debug(f"Invalidating the stack cache entry for {self.key(region, stack_name)}")
+        self.delete(self.key(region, stack_name))
+
+
+class ValidationCache(DiskCache):
+    """Class to cache the validate_template results of templates on disk, keyed by the sha256 of the template and the region.
+    Only templates that validated are cached."""
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_VALIDATION_CACHE_TTL, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        super().__init__("validate", cache_dir=cache_dir, ttl=ttl, max_entries=max_entries)
+
+    @classmethod
+    def key(cls, template):
+        return(f"{template.content_hash()}/{template.region}")
+
+    def lookup(self, template):
+        """Return the cached validate_template response for the CFTemplate, or None."""
+        response = self.get(self.key(template))
+        if response is None:
+            logger.debug(f"Validation cache miss for {template} ({self.key(template)})")
+        else:
+            logger.debug(f"Validation cache hit for {template} ({self.key(template)})")
+        return(response)
+
+    def store(self, template, response):
+        """Cache the validate_template response for the CFTemplate."""
+        self.put(self.key(template), {k: v for k, v in response.items() if k != 'ResponseMetadata'})
+
+
+def purge_cache(cache_dir=None):
+    """Remove every cft-deploy cache in cache_dir. Returns the number of entries removed."""
+    cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+    count = 0
+    if os.path.isdir(cache_dir):
+        for namespace in os.listdir(cache_dir):
+            if os.path.isdir(os.path.join(cache_dir, namespace)):
+                count += DiskCache(namespace, cache_dir=cache_dir).purge()
+    return(count)
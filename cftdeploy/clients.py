@@ -0,0 +1,143 @@
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+import threading
+
+import logging
+logger = logging.getLogger('cft-deploy.clients')
+
+
+# Enough pooled connections for the worker pools in concurrency.py, with botocore's adaptive retry mode to
+# back off (and rate limit the client) when AWS throttles us. This is the only retry layer for these clients.
+DEFAULT_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+)
+
+
+class ClientRegistry(object):
+    """Class to share boto3 clients between CFStack, CFTemplate and CFManifest objects.
+
+    Clients are created once per (session, service, region) and reused. Creating clients from a session isn't
+    thread safe, so creation is serialized; the clients themselves are safe to share between threads.
+    """
+
+    def __init__(self, config=DEFAULT_CLIENT_CONFIG):
+        self.config = config
+        self.clients = {}
+        self.sessions = {}
+        self.accounts = {}
+        self.default_session = None
+        self.lock = threading.RLock()
+
+    def get_session(self, session=None):
+        """Return session, or if it is None, a boto3 Session shared by everything using this registry."""
+        if session is not None:
+            return(session)
+        with self.lock:
+            if self.default_session is None:
+                self.default_session = boto3.session.Session()
+            return(self.default_session)
+
+    def client(self, service, region=None, session=None):
+        """Return the client for service in region, creating it the first time it is asked for."""
+        session = self.get_session(session)
+        key = (session, service, region)
+        with self.lock:
+            if key not in self.clients:
+                logger.debug(f"Creating {service} client for {region}")
+                self.clients[key] = session.client(service, region_name=region, config=self.config)
+            return(self.clients[key])
+
+    def register(self, client, service, region=None, session=None):
+        """Use client for service in region from now on. Useful for injecting stubbed clients in tests."""
+        session = self.get_session(session)
+        with self.lock:
+            self.clients[(session, service, region)] = client
+
+    def assume_role(self, role_arn, session=None, session_name="cft-deploy", duration=3600):
+        """Return a Session using role_arn, assumed from session (or the default session).
+
+        The Session is created once per (session, role_arn) and reused, along with its clients. Its credentials are
+        refreshed by assuming the role again shortly before they expire. The role is assumed outside of the lock, so
+        many roles can be assumed at once.
+        """
+        session = self.get_session(session)
+        key = (session, role_arn)
+        with self.lock:
+            if key in self.sessions:
+                return(self.sessions[key])
+        sts_client = self.client('sts', session=session)
+
+        def refresh():
+            logger.debug(f"Assuming {role_arn}")
+            credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name, DurationSeconds=duration)['Credentials']
+            return({
+                'access_key':   credentials['AccessKeyId'],
+                'secret_key':   credentials['SecretAccessKey'],
+                'token':        credentials['SessionToken'],
+                'expiry_time':  credentials['Expiration'].isoformat(),
+            })
+
+        credentials = RefreshableCredentials.create_from_metadata(metadata=refresh(), refresh_using=refresh, method='sts-assume-role')
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = credentials
+        assumed_session = boto3.session.Session(botocore_session=botocore_session, region_name=session.region_name)
+        with self.lock:
+            return(self.sessions.setdefault(key, assumed_session))
+
+    def caller_account(self, session=None):
+        """Return (partition, account id) of the credentials of session (or the default session).
+        get_caller_identity is only called the first time each session is asked about."""
+        session = self.get_session(session)
+        with self.lock:
+            if session in self.accounts:
+                return(self.accounts[session])
+        identity = self.client('sts', session=session).get_caller_identity()
+        # The Arn is arn:<partition>:sts::<account>:...
+        account = (identity['Arn'].split(":")[1], identity['Account'])
+        with self.lock:
+            return(self.accounts.setdefault(session, account))
+
+    def clear(self):
+        """Forget all the clients (and the default and assumed sessions)."""
+        with self.lock:
+            self.clients = {}
+            self.sessions = {}
+            self.accounts = {}
+            self.default_session = None
+
+
+_registry = ClientRegistry()
+
+
+def get_client_registry():
+    """Return the ClientRegistry used by cftdeploy."""
+    return(_registry)
+
+
+def set_client_registry(registry):
+    """Replace the ClientRegistry used by cftdeploy, for example with one holding stubbed clients."""
+    global _registry
+    _registry = registry
+
+
+def get_session(session=None):
+    """Return session, or the shared default session if it is None."""
+    return(_registry.get_session(session))
+
+
+def get_client(service, region=None, session=None):
+    """Return the shared client for service in region."""
+    return(_registry.client(service, region=region, session=session))
+
+
+def assume_role(role_arn, session=None, session_name="cft-deploy", duration=3600):
+    """Return the shared Session for role_arn, assumed from session. See ClientRegistry.assume_role()."""
+    return(_registry.assume_role(role_arn, session=session, session_name=session_name, duration=duration))
+
+
+def get_caller_account(session=None):
+    """Return (partition, account id) of session's credentials. See ClientRegistry.caller_account()."""
+    return(_registry.caller_account(session=session))
@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import logging
+logger = logging.getLogger('cft-deploy.concurrency')
+
+
+# Default size of the worker pools used to talk to AWS in parallel
+DEFAULT_MAX_WORKERS = 8
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """Call func(item) for every item on a bounded thread pool.
+
+    Returns a list of (item, result, exception) in the same order as items, regardless of the order the calls
+    finished in, so callers can process results and raise errors deterministically.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return([])
+
+    def _call(item):
+        try:
+            return(func(item), None)
+        except Exception as e:
+            return(None, e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        results = list(executor.map(_call, items))
+    return([(item, result, exception) for item, (result, exception) in zip(items, results)])
+
+
+class TokenBucket(object):
+    """A thread safe token bucket, used to share a budget of API calls per second between callers.
+    Tokens refill at rate per second, up to burst tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available, then take them."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
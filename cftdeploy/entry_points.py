@@ -1,53 +1,51 @@
 #!/usr/bin/env python
 
-import boto3
-from botocore.exceptions import ClientError
 import os
 import sys
 import json
-import yaml
 import argparse
-import time
-from datetime import tzinfo
-from difflib import unified_diff
 
 from ._version import __version__, __version_info__
-from .manifest import *
-from .stack import *
-from .template import *
+
+# boto3 (and yaml) are slow to import, so the cftdeploy modules that use them are imported inside each entrypoint,
+# after the arguments are parsed. --version and usage errors never pay for them.
 
 import logging
 logger = logging.getLogger('cft-deploy')
 
 
 def cft_get_events():
-    """Entrypoint to list events for a stack."""
+    """Entrypoint to list events for one or more stacks."""
     parser = argparse.ArgumentParser(description="List Stack Events")
-    parser.add_argument("--stack-name", help="Stackname to search", required=True)
+    parser.add_argument("--stack-name", help="Stackname(s) to search", required=True, nargs='+')
+    parser.add_argument("--max-api-rate", help="Maximum describe_stack_events calls per second across all stacks", type=float, default=2)
     args = do_args(parser)
+    from .stack import CFStack, CFStackMonitor, CFStackDoesNotExistError, StackGoodStatus
 
-    try:
-        my_stack = CFStack(args.stack_name, args.region)
-        my_stack.get()
-    except CFStackDoesNotExistError as e:
-        print("Failed to Find stack. Aborting....")
-        exit(1)
+    monitor = CFStackMonitor(rate=args.max_api_rate)
+    for stack_name in args.stack_name:
+        try:
+            my_stack = CFStack(stack_name, args.region)
+            my_stack.get()
+        except CFStackDoesNotExistError as e:
+            print(f"Failed to Find stack {stack_name}. Aborting....")
+            exit(1)
+        monitor.add(my_stack)
+
+    # Only prefix the event lines with the stack name when there is more than one stack
+    def on_events(stack, events):
+        print_events(events, None, prefix=stack.stack_name if len(args.stack_name) > 1 else None)
 
     # Now display the events
-    events = my_stack.get_stack_events()
-    last_event = print_events(events, None)
-    while my_stack.get_status() in StackTempStatus:
-        time.sleep(2)
-        events = my_stack.get_stack_events(last_event_id=last_event)
-        print_events(events, last_event)
-
-    status = my_stack.get_status()
-    if status in StackGoodStatus:
-        print(f"{my_manifest.stack_name} successfully deployed: \033[92m{status}\033[0m")
-        exit(0)
-    else:
-        print(f"{my_manifest.stack_name} failed deployment: \033[91m{status}\033[0m")
-        exit(1)
+    rc = 0
+    results = monitor.run(on_events=on_events)
+    for stack_name, status in results.items():
+        if status in StackGoodStatus:
+            print(f"{stack_name} successfully deployed: \033[92m{status}\033[0m")
+        else:
+            print(f"{stack_name} failed deployment: \033[91m{status}\033[0m")
+            rc = 1
+    exit(rc)
 
 
 def cft_deploy():
@@ -55,31 +53,61 @@ def cft_deploy():
     parser = argparse.ArgumentParser(description="Deploy a cft-tool manifest")
     parser.add_argument("-m", "--manifest", help="Manifest file to deploy", required=True)
     parser.add_argument("--template-url", help="Override the manifest with this Template URL")
-    parser.add_argument("--override-region", help="Override the region defined in the manifest with this value")
+    regions = parser.add_mutually_exclusive_group()
+    regions.add_argument("--override-region", help="Override the region defined in the manifest with this value")
+    regions.add_argument("--regions", help="Deploy the manifest into each of these regions at once", nargs='+')
+    regions.add_argument("--all-regions", help="Deploy the manifest into every region enabled in the account at once", action='store_true')
+    parser.add_argument("--max-regions", help="Maximum number of regions to deploy to at once", type=int, default=8)
+    parser.add_argument("--accounts", help="Deploy the manifest into each of these account ids, through --role-name", nargs='+')
+    parser.add_argument("--role-name", help="Role to assume in each of the --accounts", default="OrganizationAccountAccessRole")
+    parser.add_argument("--max-accounts", help="Maximum number of accounts to deploy to at once", type=int, default=8)
+    parser.add_argument("--failure-tolerance", help="Stop starting accounts once more than this many have failed", type=int, default=0)
     parser.add_argument("--force", help="Force the stack update even if the stack is in a non-normal state", action='store_true')
     parser.add_argument("--update-stack-policy", help="Override the existing stack policy for this update", action='store_true')
     parser.add_argument("--interactive", help="Create a change set and display it before executing the change", action='store_true')
+    parser.add_argument("--skip-unchanged", help="Compare the stack's template, parameters, tags and stack policy with the manifest's, "
+                        "and don't update it if they are the same", action='store_true')
     parser.add_argument("overrideparameters", help="Optional parameter override of the manifest", nargs='*')
     # parser.add_argument("--region", help="Make API Calls in this region")
     parser.add_argument("--profile", help="Use the BOTO3 Profile")
+    add_staging_args(parser)
+    add_cache_args(parser)
 
     args = do_args(parser)
+    import boto3
+    from .clients import get_session
+    from .manifest import CFManifest
+    from .stack import CFStack, CFStackWatcher, StackGoodStatus
     logger.info(f"Deploying {args.manifest}")
 
     # Flag the non-implemented stuff
-    if args.interactive or args.update_stack_policy:
+    if args.update_stack_policy:
         raise NotImplementedError
 
     if not args.profile:
-        session =  boto3.session.Session()
+        session = get_session()
     else:
         session = boto3.session.Session(profile_name=args.profile)
 
+    if args.accounts:
+        if args.interactive or args.regions or args.all_regions or args.template_url:
+            logger.critical("--accounts can't be used with --interactive, --regions, --all-regions or --template-url")
+            exit(1)
+        exit(deploy_accounts(args, session))
+
+    if args.regions or args.all_regions:
+        if args.interactive:
+            logger.critical("--interactive can only be used to deploy to one region")
+            exit(1)
+        exit(deploy_regions(args, session))
+
     try:
         if args.override_region:
-            my_manifest = CFManifest(args.manifest, region=args.override_region, session=session)
+            my_manifest = CFManifest(args.manifest, region=args.override_region, session=session, cache=get_stack_cache(args, session),
+                                     staging_bucket=args.staging_bucket, skip_unchanged=args.skip_unchanged)
         else:
-            my_manifest = CFManifest(args.manifest,  session=session)
+            my_manifest = CFManifest(args.manifest,  session=session, cache=get_stack_cache(args, session), staging_bucket=args.staging_bucket,
+                                     skip_unchanged=args.skip_unchanged)
     except Exception:
         raise
         exit(1)
@@ -90,46 +118,49 @@ def cft_deploy():
 
     override = process_override_params(args)
 
-    # Now see if the stack exists, if it doesn't then create, otherwise update
-    try:
-        my_stack = CFStack(my_manifest.stack_name, my_manifest.document['Region'],  session=session)
-        stack_id = my_stack.get()
-        if stack_id is None:
-            print(f"Cannot find a stack named {my_manifest.stack_name}")
-            exit(1)
-
-        # Only if the stack is in a normal status (or --force is specified) do we update
-        status = my_stack.get_status()
-        if status not in StackGoodStatus and args.force is not True:
-            print(f"Stack {my_stack.stack_name} is in status {status} and --force was not specified. Aborting....")
+    if args.interactive:
+        # Create a change set, show it, and only execute it if asked to
+        my_stack = my_manifest.create_changeset(override=override)
+        if my_stack is None:
+            print("Failed to create a change set. Aborting....")
             exit(1)
-
-        rc = my_stack.update(manifest=my_manifest, override=override)
-        if rc is None:
-            print("Failed to Find or Update stack. Aborting....")
+        status = my_stack.wait_for_changeset()
+        if CFStack.changeset_is_empty(status):
+            my_manifest.discard_changeset(my_stack)
+            print(f"{my_manifest.stack_name} has no updates to be performed")
+            exit(0)
+        if status['Status'] != "CREATE_COMPLETE":
+            my_manifest.discard_changeset(my_stack)
+            print(f"Failed to create a change set for {my_manifest.stack_name}: {status['StatusReason']}")
             exit(1)
-    except CFStackDoesNotExistError as e:
-        logger.info(e)
+        print(f"Change set {my_stack.changeset_name} for {my_manifest.stack_name}:")
+        print_changes(CFStack.summarize_changes(my_stack.describe_changeset()['Changes']))
+        if input("Execute this change set? [y/N] ").strip().lower() not in ["y", "yes"]:
+            my_manifest.discard_changeset(my_stack)
+            print("Change set discarded")
+            exit(0)
+        my_manifest.execute_changeset(my_stack)
+    else:
+        # Now see if the stack exists, if it doesn't then create, otherwise update
         try:
-            # Then we're creating the stack
-            my_stack = my_manifest.create_stack(override=override)
-            if my_stack is None:
-                print("Failed to Create stack. Aborting....")
-                exit(1)
-            my_stack.get()
+            my_stack = my_manifest.deploy(override=override, force=args.force)
         except Exception as e:
+            logger.critical(f"Failed to deploy {my_manifest.stack_name}: {e}")
+            exit(1)
+        if my_stack is None:
+            print("Failed to Create or Update stack. Aborting....")
             exit(1)
 
+    if my_stack.operation == "NOOP":
+        print(f"{my_manifest.stack_name} has no updates to be performed: \033[92m{my_stack.StackStatus}\033[0m")
+        exit(0)
+
     # Now display the events
-    events = my_stack.get_stack_events()
-    last_event = print_events(events, None)
-    while my_stack.get_status() in StackTempStatus:
-        time.sleep(5)
-        events = my_stack.get_stack_events(last_event_id=last_event)
-        last_event = print_events(events, last_event)
+    watcher = CFStackWatcher(my_stack, client_request_token=my_stack.client_request_token)
+    status = watcher.wait(on_events=lambda stack, events: print_events(events, None))
+    my_manifest.invalidate_cache()
 
     # Finish up with an status message and the appropriate exit code
-    status = my_stack.get_status()
     if status in StackGoodStatus:
         print(f"{my_manifest.stack_name} successfully deployed: \033[92m{status}\033[0m")
         exit(0)
@@ -138,7 +169,128 @@ def cft_deploy():
         exit(1)
 
 
-def print_events(events, last_event):
+def deploy_regions(args, session):
+    """Deploy cft-deploy's manifest into --regions or --all-regions at once, tailing the events of every region.
+    Prints a summary of each region's status and returns the exit code."""
+    from .orchestrator import CFRegionalDeploy
+    from .stack import StackGoodStatus
+
+    regions = args.regions if args.regions else CFRegionalDeploy.enabled_regions(session, region=args.region)
+    logger.info(f"Deploying {args.manifest} to {', '.join(regions)}")
+    regional = CFRegionalDeploy([args.manifest], regions, session=session, staging_bucket=args.staging_bucket,
+                                skip_unchanged=args.skip_unchanged, cache=get_stack_cache(args, session))
+    if args.template_url:
+        for plan in regional.plans.values():
+            for my_manifest in plan.manifests.values():
+                my_manifest.override_option("S3Template", args.template_url)
+
+    results = regional.deploy(max_regions=args.max_regions, override=process_override_params(args), force=args.force,
+                              on_events=lambda region, stack, events: print_events(events, None, prefix=region))
+    statuses = {region: next(iter(results[region].values())) for region in regions}
+
+    if args.json:
+        print(json.dumps(statuses, indent=2))
+    else:
+        print("\nDeployment Summary:")
+        for region, status in statuses.items():
+            color = "92" if status in StackGoodStatus else "91"
+            print(f"\t{region}: \033[{color}m{status}\033[0m")
+    return(0 if all(status in StackGoodStatus for status in statuses.values()) else 1)
+
+
+def deploy_accounts(args, session):
+    """Deploy cft-deploy's manifest into each of --accounts, printing each account's result as it finishes.
+    Prints a summary and returns the exit code."""
+    from .orchestrator import CFAccountDeploy, DeploySkipped
+    from .stack import StackGoodStatus
+
+    def print_result(account, results):
+        if args.json:
+            print(json.dumps({'Account': account, 'Stacks': results}), flush=True)
+            return
+        for stack_name, status in results.items():
+            color = "92" if status in StackGoodStatus else "91"
+            print(f"[{account}] {stack_name}: \033[{color}m{status}\033[0m", flush=True)
+
+    logger.info(f"Deploying {args.manifest} to {len(args.accounts)} accounts as {args.role_name}")
+    fan_out = CFAccountDeploy([args.manifest], args.accounts, args.role_name, session=session, region=args.override_region,
+                              staging_bucket=args.staging_bucket, skip_unchanged=args.skip_unchanged,
+                              get_cache=lambda account: get_stack_cache(args, session, account))
+    on_events = None if args.json else (lambda account, stack, events: print_events(events, None, prefix=account))
+    results = fan_out.deploy(max_accounts=args.max_accounts, override=process_override_params(args), force=args.force,
+                             on_events=on_events, on_result=print_result, failure_tolerance=args.failure_tolerance)
+
+    succeeded = [a for a, r in results.items() if all(status in StackGoodStatus for status in r.values())]
+    skipped = [a for a, r in results.items() if all(status == DeploySkipped for status in r.values())]
+    failed = [a for a in results if a not in succeeded and a not in skipped]
+    if not args.json:
+        print(f"\n{len(results)} accounts: {len(succeeded)} succeeded, {len(failed)} failed, {len(skipped)} skipped")
+        if len(failed) > 0:
+            print(f"Failed: {', '.join(failed)}")
+    return(0 if len(succeeded) == len(results) else 1)
+
+
+def cft_deploy_many():
+    """Entrypoint to deploy a set of manifests, in parallel waves ordered by their DependentStacks."""
+    parser = argparse.ArgumentParser(description="Deploy a set of cft-tool manifests in dependency order")
+    parser.add_argument("-m", "--manifest", help="Manifest files to deploy", required=True, nargs='+')
+    parser.add_argument("--max-concurrency", help="Maximum number of stacks to deploy at once", type=int, default=4)
+    parser.add_argument("--max-api-rate", help="Maximum describe_stack_events calls per second across all stacks", type=float, default=2)
+    parser.add_argument("--override-region", help="Override the region defined in the manifests with this value")
+    parser.add_argument("--force", help="Force the stack updates even if a stack is in a non-normal state", action='store_true')
+    parser.add_argument("--dry-run", help="Print the deployment waves and exit", action='store_true')
+    parser.add_argument("--skip-unchanged", help="Compare each stack's template, parameters, tags and stack policy with its "
+                        "manifest's, and don't update the stacks where they are the same", action='store_true')
+    parser.add_argument("overrideparameters", help="Optional parameter override of every manifest", nargs='*')
+    parser.add_argument("--profile", help="Use the BOTO3 Profile")
+    add_staging_args(parser)
+
+    args = do_args(parser)
+    from .orchestrator import CFDeployPlan, CFDeployPlanError
+    from .stack import StackGoodStatus
+
+    try:
+        plan = CFDeployPlan(args.manifest, region=args.override_region, profile=args.profile, staging_bucket=args.staging_bucket,
+                            skip_unchanged=args.skip_unchanged)
+        waves = plan.waves()
+    except CFDeployPlanError as e:
+        logger.critical(f"Unable to plan deployment: {e}")
+        exit(1)
+
+    for i, wave in enumerate(waves, start=1):
+        print(f"Wave {i}: {', '.join(wave)}")
+    if args.dry_run:
+        exit(0)
+
+    override = process_override_params(args)
+    results = plan.deploy(max_concurrency=args.max_concurrency, override=override, force=args.force, max_api_rate=args.max_api_rate,
+                          on_events=lambda stack, events: print_events(events, None, prefix=stack.stack_name))
+
+    # Finish up with a summary and the appropriate exit code
+    rc = 0
+    print("\nDeployment Summary:")
+    for wave in waves:
+        for stack_name in wave:
+            status = results[stack_name]
+            if status in StackGoodStatus:
+                print(f"\t{stack_name}: \033[92m{status}\033[0m")
+            else:
+                print(f"\t{stack_name}: \033[91m{status}\033[0m")
+                rc = 1
+    exit(rc)
+
+
+def print_changes(changes, prefix=""):
+    """Print the resource changes of a change set, as returned by CFStack.summarize_changes()."""
+    for c in changes:
+        replacement = "\033[91mReplacement\033[0m" if c['Replacement'] == "True" else \
+            ("\033[93mConditional Replacement\033[0m" if c['Replacement'] == "Conditional" else "")
+        print(f"{prefix}{c['Action']:<8} {c['LogicalResourceId']:<40} {c['ResourceType']:<40} {replacement}")
+
+
+def print_events(events, last_event, prefix=None):
+    """Print the events with colorized statuses, optionally prefixing each line (with a stack name, for example).
+    Returns the EventId of the last event printed."""
     # Events is structured as such:
     # [
     #     {
@@ -153,6 +305,7 @@ def print_events(events, last_event):
     #         'ResourceStatusReason': 'User Initiated'
     #     }
     # ]
+    from .stack import ResourceTempStatus, ResourceBadStatus, ResourceGoodStatus
     if len(events) == 0:
         return(last_event)
     for e in events:
@@ -170,10 +323,55 @@ def print_events(events, last_event):
             reason = f": {e['ResourceStatusReason']}"
         else:
             reason = ""
-        print(f"{e['Timestamp'].astimezone().strftime('%Y-%m-%d %H:%M:%S')} {e['LogicalResourceId']} ({e['ResourceType']}): {status} {reason}")
+        line = f"{e['Timestamp'].astimezone().strftime('%Y-%m-%d %H:%M:%S')} {e['LogicalResourceId']} ({e['ResourceType']}): {status} {reason}"
+        if prefix is not None:
+            line = f"[{prefix}] {line}"
+        print(line)
     return(e['EventId'])
 
 
+def cft_preview():
+    """Entrypoint to preview the changes to a set of manifests' stacks, with change sets that aren't executed."""
+    parser = argparse.ArgumentParser(description="Preview the changes a set of cft-tool manifests would make, with change sets")
+    parser.add_argument("-m", "--manifest", help="Manifest files to preview", required=True, nargs='+')
+    parser.add_argument("--max-concurrency", help="Maximum number of change sets to create at once", type=int, default=8)
+    parser.add_argument("--max-api-rate", help="Maximum describe_change_set calls per second across all stacks", type=float, default=2)
+    parser.add_argument("--override-region", help="Override the region defined in the manifests with this value")
+    parser.add_argument("--keep-changesets", help="Don't delete the change sets after describing them", action='store_true')
+    parser.add_argument("overrideparameters", help="Optional parameter override of every manifest", nargs='*')
+    parser.add_argument("--profile", help="Use the BOTO3 Profile")
+    add_staging_args(parser)
+
+    args = do_args(parser)
+    from .orchestrator import CFDeployPlan, CFDeployPlanError
+
+    try:
+        plan = CFDeployPlan(args.manifest, region=args.override_region, profile=args.profile, staging_bucket=args.staging_bucket)
+    except CFDeployPlanError as e:
+        logger.critical(f"Unable to plan deployment: {e}")
+        exit(1)
+
+    override = process_override_params(args)
+    report = plan.preview(max_concurrency=args.max_concurrency, override=override, max_api_rate=args.max_api_rate,
+                          keep=args.keep_changesets)
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        for stack_report in report['Stacks']:
+            if 'Error' in stack_report:
+                print(f"{stack_report['StackName']}: \033[91mERROR\033[0m {stack_report['Error']}")
+            elif len(stack_report['Changes']) == 0:
+                print(f"{stack_report['StackName']}: no changes")
+            else:
+                print(f"{stack_report['StackName']}: {len(stack_report['Changes'])} changes ({stack_report['ChangeSetType']})")
+                print_changes(stack_report['Changes'], prefix="    ")
+        print("\nPreview Summary:")
+        for k, v in report['Summary'].items():
+            print(f"    {k}: {v}")
+    exit(1 if report['Summary']['Errors'] > 0 else 0)
+
+
 def cft_get_resource():
     """Get a resource's physical ID. Can be specified multiple times."""
     parser = argparse.ArgumentParser(description="Get Resource IDs by Logical Id")
@@ -186,68 +384,165 @@ def cft_get_resource():
 
 
 def cft_get_output():
-    """Get a resource's physical ID. Can be specified multiple times."""
-    parser = argparse.ArgumentParser(description="Get Resource IDs by Logical Id")
-    parser.add_argument("--stack-name", help="Stackname to search", required=True)
-    parser.add_argument("--output-key", help="Stack Output to return", required=True)
+    """Get the Outputs of one or more stacks, in one pass."""
+    parser = argparse.ArgumentParser(description="Get Stack Outputs")
+    parser.add_argument("--stack-name", help="Stackname(s) to search", required=True, nargs='+')
+    parser.add_argument("--output-key", help="Stack Output(s) to return. Returns all outputs if not specified", nargs='*')
     parser.add_argument("--profile", help="Use the BOTO3 Profile")
+    add_cache_args(parser)
 
     args = do_args(parser)
-    logger.debug(f"Looking for {args.output_key} in {args.stack_name}")
+    import boto3
+    from .clients import get_session
+    from .stack import CFStack, CFStackDoesNotExistError
+    logger.debug(f"Looking for {args.output_key or 'all outputs'} in {args.stack_name}")
 
     if not args.profile:
-        session =  boto3.session.Session()
+        session = get_session()
     else:
         session = boto3.session.Session(profile_name=args.profile)
 
     try:
-        my_stack = CFStack(args.stack_name, args.region, session=session)
-        my_stack.get()
-        stack_outputs = my_stack.get_outputs()
-
-        if args.output_key not in stack_outputs:
-            logger.critical(f"Failed to find output {args.output_key} in stack {args.stack_name} in region {args.stack_name}.")
-            exit(1)
-        else:
-            print(stack_outputs[args.output_key])
-            exit(0)
-
+        stacks = CFStack.get_many(args.stack_name, args.region, session=session, cache=get_stack_cache(args, session))
     except CFStackDoesNotExistError as e:
-        logger.critical(f"Failed to find stack {args.stack_name} in region {args.region}. Aborting....")
+        logger.critical(f"Failed to find stack {e.stackname} in region {args.region}. Aborting....")
         exit(1)
 
+    # stack_name -> {output_key: value}
+    results = {}
+    for stack_name, my_stack in stacks.items():
+        stack_outputs = my_stack.get_outputs(refresh=False)
+        if not args.output_key:
+            results[stack_name] = stack_outputs
+            continue
+        results[stack_name] = {}
+        for output_key in args.output_key:
+            if output_key not in stack_outputs:
+                logger.critical(f"Failed to find output {output_key} in stack {stack_name} in region {args.region}.")
+                exit(1)
+            results[stack_name][output_key] = stack_outputs[output_key]
+
+    multiple_stacks = len(results) > 1
+    if args.json:
+        print(json.dumps(results if multiple_stacks else results[args.stack_name[0]], sort_keys=True, indent=2))
+    elif args.env:
+        import re
+        import shlex
+        for stack_name, outputs in results.items():
+            for k, v in outputs.items():
+                # With more than one stack, prefix the variables with the stack name so they don't collide
+                name = re.sub(r"\W", "_", f"{stack_name}_{k}" if multiple_stacks else k)
+                print(f"export {name}={shlex.quote(str(v))}")
+    elif not multiple_stacks and args.output_key and len(args.output_key) == 1:
+        print(results[args.stack_name[0]][args.output_key[0]])
+    else:
+        for stack_name, outputs in results.items():
+            for k, v in outputs.items():
+                print(f"{stack_name}\t{k}\t{v}" if multiple_stacks else f"{k}\t{v}")
     exit(0)
 
 
 def cft_validate():
-    """Entrypoint to Validate a Cloudformation Template File."""
-    parser = argparse.ArgumentParser(description="Validate a Cloudformation Template File")
+    """Entrypoint to Validate Cloudformation Template Files."""
+    parser = argparse.ArgumentParser(description="Validate Cloudformation Template Files")
     group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument("-t", "--template", help="CFT Filename to validate")
-    group.add_argument("--s3-url", help="CFT S3 URL to validate")
+    group.add_argument("-t", "--template", help="CFT Filename(s), globs or directories of templates to validate", nargs='+')
+    group.add_argument("--s3-url", help="CFT S3 URL(s) to validate, or prefixes ending in / to validate all the templates under",
+                       nargs='+')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--offline", help="Only check the templates' structure locally, without calling AWS", action='store_true')
+    mode.add_argument("--lint", help="Check the templates' structure locally before validating them with AWS", action='store_true')
+    parser.add_argument("--minify", help="Validate the template minified to compact json, and report its size before and after",
+                        action='store_true')
+    parser.add_argument("--max-workers", help="Number of templates to download or validate at once", type=int, default=8)
+    parser.add_argument("--max-api-rate", help="Maximum validate_template calls per second", type=float, default=5)
+    add_staging_args(parser)
+    add_validation_cache_args(parser)
     args = do_args(parser)
+    from .template import CFTemplate, CFTemplateTooLargeError, lint_many
+    from .clients import get_client
+    from .concurrency import TokenBucket, run_concurrently
+    from botocore.exceptions import ClientError
 
+    validation_cache = get_validation_cache(args)
     if args.template:
-        logger.debug(f"Validating {args.template}")
-        my_template = CFTemplate.read(args.template, args.region)
-    elif args.s3_url:
-        logger.debug(f"Validating {args.s3_url}")
-        (bucket, object_key) = CFTemplate.parse_s3_url(args.s3_url)
-        logger.debug(f"Fetching {object_key} from {bucket}")
-        my_template = CFTemplate.download(bucket, object_key, args.region)
+        sources = [f for path in args.template for f in CFTemplate.find_templates(path)]
+    else:
+        s3_client = get_client('s3')
+        sources = [u for url in args.s3_url for u in CFTemplate.find_s3_templates(url, s3_client=s3_client)]
+    if len(sources) == 0:
+        logger.critical(f"No templates found in {' '.join(args.template or args.s3_url)}. Aborting....")
+        exit(1)
 
-    try:
-        status = my_template.validate()
-        if status is None:
-            print("Error Validating Template")
-            exit(1)
+    def load(source):
+        if args.template:
+            return(CFTemplate.read(source, args.region, staging_bucket=args.staging_bucket, validation_cache=validation_cache))
+        (bucket, object_key) = CFTemplate.parse_s3_url(source)
+        return(CFTemplate.download(bucket, object_key, args.region, validation_cache=validation_cache, s3_client=s3_client))
+
+    if args.offline or args.lint:
+        if args.template:
+            results = lint_many(sources)
         else:
-            print(f"Template {args.template} is valid")
-            exit(0)
-    except CFTemplateTooLargeError:
-        parser.print_help()
-        print(f"\n\nTemplate {args.template} exceeds the maximum length for local templates")
-        print("Please upload the file to S3, then call cfg-validate with the --s3-url option")
+            linted = run_concurrently(lambda u: load(u).lint(), sources, max_workers=args.max_workers)
+            results = {u: problems if e is None else [{'Severity': "error", 'Message': f"Unable to download: {e}"}]
+                       for u, problems, e in linted}
+        failed = [f for f, problems in results.items() if any(p['Severity'] == "error" for p in problems)]
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for f, problems in results.items():
+                for p in problems:
+                    print(f"{f}: {p['Severity']}: {p['Message']}")
+                if f not in failed and args.offline:
+                    print(f"Template {f} passed the offline checks")
+        if args.offline or len(failed) > 0:
+            exit(1 if failed else 0)
+
+    api_bucket = TokenBucket(args.max_api_rate)
+
+    def validate(source):
+        """Load, validate and report on one template. Only the templates in flight are held in memory."""
+        result = {'Template': source, 'Size': None}
+        try:
+            my_template = load(source)
+        except (ClientError, OSError, UnicodeDecodeError) as e:
+            result.update({'Result': "ERROR", 'Message': f"Unable to read: {e}"})
+            return(result)
+        result['Size'] = my_template.size()
+        my_template.always_minify = args.minify and my_template.filename is not None
+        try:
+            api_bucket.acquire()
+            status = my_template.validate()
+            if status is None:
+                result.update({'Result': "INVALID", 'Message': my_template.validation_error})
+            else:
+                result.update({'Result': "VALID", 'Message': None})
+        except CFTemplateTooLargeError:
+            result.update({'Result': "TOO_LARGE", 'Message': "Use --staging-bucket, or upload the template to S3 and use --s3-url"})
+        except ClientError as e:
+            result.update({'Result': "ERROR", 'Message': str(e)})
+        if my_template.always_minify and my_template.minified_body is not None:
+            result['MinifiedSize'] = len(my_template.minified_body.encode('utf-8'))
+        return(result)
+
+    report = []  # a dict per template of its Result, in the order of sources
+    for source, result, e in run_concurrently(validate, sources, max_workers=args.max_workers):
+        report.append(result if e is None else {'Template': source, 'Size': None, 'Result': "ERROR", 'Message': str(e)})
+
+    summary = {r: len([t for t in report if t['Result'] == r]) for r in ["VALID", "INVALID", "TOO_LARGE", "ERROR"]}
+    summary['Templates'] = len(report)
+    if args.json:
+        print(json.dumps({'Templates': report, 'Summary': summary}, indent=2))
+    else:
+        width = max([len("TEMPLATE")] + [len(r['Template']) for r in report])
+        print(f"{'TEMPLATE':<{width}}  {'SIZE':>15}  {'RESULT':<9}  MESSAGE")
+        for r in report:
+            size = f"{r['Size'] or ''}" if 'MinifiedSize' not in r else f"{r['Size']}->{r['MinifiedSize']}"
+            print(f"{r['Template']:<{width}}  {size:>15}  {r['Result']:<9}  {r['Message'] or ''}")
+        print(f"{summary['Templates']} templates: {summary['VALID']} valid, {summary['INVALID']} invalid, "
+              f"{summary['TOO_LARGE']} too large, {summary['ERROR']} errors")
+    exit(0 if summary['VALID'] == summary['Templates'] else 1)
 
 
 def cft_validate_manifest():
@@ -258,13 +553,17 @@ def cft_validate_manifest():
     parser.add_argument("--override-region", help="Override the region defined in the manifest with this value")
     parser.add_argument("-m", "--manifest", help="Manifest file to deploy", required=True)
     parser.add_argument("overrideparameters", help="Optional parameter override of the manifest", nargs='*')
+    add_staging_args(parser)
+    add_cache_args(parser)
     args = do_args(parser)
+    from .manifest import CFManifest, StackLookupException
+    from .stack import CFStackDoesNotExistError
     logger.debug(f"Validating {args.manifest}")
 
     if args.override_region:
-        my_manifest = CFManifest(args.manifest, region=args.override_region)
+        my_manifest = CFManifest(args.manifest, region=args.override_region, cache=get_stack_cache(args), staging_bucket=args.staging_bucket)
     else:
-        my_manifest = CFManifest(args.manifest)
+        my_manifest = CFManifest(args.manifest, cache=get_stack_cache(args), staging_bucket=args.staging_bucket)
 
     override = process_override_params(args)
 
@@ -298,22 +597,50 @@ def cft_validate_manifest():
         exit(1)
 
 def cft_upload():
-    """Entrypoint to upload a Cloudformation Template File to s3."""
-    parser = argparse.ArgumentParser(description="Upload a Cloudformation Template File")
-    parser.add_argument("-t", "--template", help="CFT Filename to upload", required=True)
+    """Entrypoint to upload Cloudformation Template Files to s3."""
+    parser = argparse.ArgumentParser(description="Upload Cloudformation Template Files. Unchanged templates are not uploaded again")
+    parser.add_argument("-t", "--template", help="CFT Filename(s) or directories of templates to upload", required=True, nargs='+')
     parser.add_argument("-b", "--bucket", help="Bucket to upload to", required=True)
-    parser.add_argument("-o", "--object-key", help="object key to upload as", required=True)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-o", "--object-key", help="object key to upload a single template as")
+    group.add_argument("--content-addressed", help="Name each object after the sha256 of the template", action='store_true')
+    parser.add_argument("--prefix", help="Prefix for the object keys. Otherwise the template's path is used", default="")
+    parser.add_argument("--force", help="Upload templates even if they are unchanged", action='store_true')
+    parser.add_argument("--max-workers", help="Number of templates to upload at once", type=int, default=8)
     args = do_args(parser)
-    logger.info(f"Uploading {args.template} to s3://{args.bucket}/{args.object_key}")
-    my_template = CFTemplate.read(args.template, args.region)
-    try:
-        status = my_template.upload(args.bucket, args.object_key)
-        print(f"Template {args.template} uploaded to {status}")
-        exit(0)
-    except ClientError as e:
-        print(f"Failed to upload Template {args.template}: {e}")
+    from .template import CFTemplate
+
+    filenames = [f for path in args.template for f in CFTemplate.find_templates(path)]
+    if args.object_key and len(filenames) != 1:
+        logger.critical("--object-key can only be used to upload a single template")
         exit(1)
 
+    uploads = []
+    for filename in filenames:
+        my_template = CFTemplate.read(filename, args.region)
+        if args.object_key:
+            object_key = args.object_key
+        elif args.content_addressed:
+            object_key = my_template.content_addressed_key(args.prefix)
+        else:
+            # Keep the layout of any directories given
+            base = next((p for p in args.template if os.path.isdir(p) and filename.startswith(os.path.join(p, ""))), None)
+            relative = os.path.relpath(filename, base) if base else os.path.basename(filename)
+            object_key = args.prefix + relative.replace(os.sep, "/")
+        logger.info(f"Uploading {filename} to s3://{args.bucket}/{object_key}")
+        uploads.append((my_template, object_key))
+
+    failed = 0
+    for my_template, status, e in CFTemplate.upload_many(uploads, args.bucket, force=args.force, max_workers=args.max_workers):
+        if e is not None:
+            print(f"Failed to upload Template {my_template.filename}: {e}")
+            failed += 1
+        elif my_template.uploaded:
+            print(f"Template {my_template.filename} uploaded to {status}")
+        else:
+            print(f"Template {my_template.filename} unchanged at {status}")
+    exit(1 if failed else 0)
+
 
 def cft_generate_manifest():
     """Entrypoint to generate manifest file based on the CloudFormation Template."""
@@ -324,13 +651,17 @@ def cft_generate_manifest():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-t", "--template", help="CFT Filename to validate")
     group.add_argument("--s3-url", help="CFT S3 URL to validate")
+    add_staging_args(parser)
+    add_validation_cache_args(parser)
     args = do_args(parser)
+    import yaml
+    from .template import CFTemplate, CFTemplateTooLargeError
     logger.info(f"Generating {args.manifest} from {args.template}")
 
     if args.template:
         logger.info(f"Generating Manifest file {args.manifest} from {args.template}")
         source = args.template
-        my_template = CFTemplate.read(args.template, args.region)
+        my_template = CFTemplate.read(args.template, args.region, staging_bucket=args.staging_bucket, validation_cache=get_validation_cache(args))
     elif args.s3_url:
         logger.info(f"Generating Manifest file {args.manifest} from {args.s3_url}")
         source = args.s3_url
@@ -339,7 +670,7 @@ def cft_generate_manifest():
             logger.critical(f"Invalid S3 URL. Cannot extract bucket or object. Aborting")
             exit(1)
         logger.debug(f"Fetching {object_key} from {bucket}")
-        my_template = CFTemplate.download(bucket, object_key, args.region)
+        my_template = CFTemplate.download(bucket, object_key, args.region, validation_cache=get_validation_cache(args))
 
     subsitutions = {}
     if args.stack_name:
@@ -356,7 +687,8 @@ def cft_generate_manifest():
     except CFTemplateTooLargeError:
         parser.print_help()
         print(f"\n\nTemplate {args.template} exceeds the maximum length for local templates")
-        print("Please upload the file to S3, then call cfg-generate-manifest with the --s3-url option")
+        print("Please use --staging-bucket, or upload the file to S3 and call cft-generate-manifest with the --s3-url option")
+        exit(1)
     except yaml.scanner.ScannerError as e:
         print("CFT Default Params have an invalid yaml value. Double check quoting before deploying")
 
@@ -367,6 +699,7 @@ def cft_delete():
     parser.add_argument("--stack-name", help="Stackname to Delete", required=True)
     parser.add_argument("--no-status", help="Don't display the progress of the delete", action='store_true')
     args = do_args(parser)
+    from .stack import CFStack, CFStackWatcher, CFStackDoesNotExistError
     print(f"Deleting {args.stack_name}")
     try:
         my_stack = CFStack(args.stack_name, args.region)
@@ -380,14 +713,8 @@ def cft_delete():
         exit(0)
 
     # Now display the events
-    events = my_stack.get_stack_events()
-    last_event = print_events(events, None)
-    while my_stack.get_status() in StackTempStatus:
-        time.sleep(5)
-        events = my_stack.get_stack_events(last_event_id=last_event)
-        last_event = print_events(events, last_event)
-
-    status = my_stack.get_status()
+    watcher = CFStackWatcher(my_stack, client_request_token=my_stack.client_request_token)
+    status = watcher.wait(on_events=lambda stack, events: print_events(events, None))
     if status in ["DELETE_COMPLETE"]:
         print(f"{args.stack_name} successfully deleted: \033[92m{status}\033[0m")
         exit(0)
@@ -397,13 +724,16 @@ def cft_delete():
 
 
 def cft_diff():
-    """Delete --stack-name."""
-    parser = argparse.ArgumentParser(description="Compare new Template to existing template from a stack")
+    """Entrypoint to compare a template to the one deployed in a stack."""
+    parser = argparse.ArgumentParser(description="Compare new Template to existing template from a stack. Exits 1 if they differ")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-t", "--template", help="CFT Filename to validate")
     group.add_argument("--s3-url", help="CFT S3 URL to validate")
     parser.add_argument("--stack-name", help="Stackname to search", required=True)
+    parser.add_argument("--unified", help="Compare the template bodies line by line, rather than their content", action='store_true')
     args = do_args(parser)
+    from .stack import CFStack, CFStackDoesNotExistError
+    from .template import CFTemplate, format_changes
 
     if args.template:
         template_1 = CFTemplate.read(args.template, args.region)
@@ -418,16 +748,126 @@ def cft_diff():
         print("Failed to Find stack. Aborting....")
         exit(1)
 
-    print(f"comparing stack: {my_stack.stack_name} and template {template_1}")
+    logger.info(f"comparing stack: {my_stack.stack_name} and template {template_1}")
     template_2 = my_stack.get_template()
 
-    s1 = template_1.template_body.split('\n')
-    s2 = template_2.template_body.split('\n')
+    if args.unified:
+        from difflib import unified_diff
+        s1 = template_2.template_body.split('\n')
+        s2 = template_1.template_body.split('\n')
+        lines = list(unified_diff(s1, s2, fromfile=my_stack.stack_name, tofile=str(template_1), lineterm=""))
+        for line in lines:
+            sys.stdout.write(line + "\n")
+        exit(1 if lines else 0)
+
+    try:
+        changes = template_2.diff(template_1)
+    except ValueError as e:
+        logger.critical(f"Unable to compare {my_stack.stack_name} and {template_1}: {e}. Aborting....")
+        exit(1)
+    if args.json:
+        print(json.dumps(changes, indent=2, default=str))
+    elif len(changes) == 0:
+        print(f"No differences between {my_stack.stack_name} and {template_1}")
+    else:
+        for line in format_changes(changes):
+            print(line)
+    exit(1 if changes else 0)
+
+
+def cft_find_stack():
+    """Entrypoint to find the stacks that own many physical resource ids, in one pass."""
+    parser = argparse.ArgumentParser(description="Find the stacks that own resources, by PhysicalResourceId")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--physical-id", help="PhysicalResourceId(s) to find", nargs='+')
+    group.add_argument("--physical-id-file", help="File of PhysicalResourceIds to find, one per line ('-' for stdin)")
+    parser.add_argument("--max-workers", help="Number of stacks to list at once", type=int, default=8)
+    parser.add_argument("--profile", help="Use the BOTO3 Profile")
+    add_cache_args(parser)
+
+    args = do_args(parser)
+    import boto3
+    from .clients import get_session
+
+    if args.physical_id:
+        physical_ids = args.physical_id
+    elif args.physical_id_file == "-":
+        physical_ids = [line.strip() for line in sys.stdin if line.strip()]
+    else:
+        with open(args.physical_id_file, "r") as f:
+            physical_ids = [line.strip() for line in f if line.strip()]
+
+    if not args.profile:
+        session = get_session()
+    else:
+        session = boto3.session.Session(profile_name=args.profile)
+
+    # --index is implied, as this always works from the index
+    args.index = True
+    index = get_stack_cache(args, session)
+
+    # Print each match as a line of json as soon as it's found
+    found = set()
+    for match in index.find_resources(physical_ids, args.region, session=session, max_workers=args.max_workers):
+        found.add(match['PhysicalResourceId'])
+        print(json.dumps(match), flush=True)
+
+    missing = [p for p in physical_ids if p not in found]
+    for physical_id in missing:
+        logger.error(f"Unable to find a stack for {physical_id} in {args.region}")
+    logger.debug(f"Found {len(found)} of {len(set(physical_ids))} resources with {index.api_calls} API calls")
+    exit(1 if missing else 0)
 
-    for line in unified_diff(s1, s2, fromfile=my_stack.stack_name, tofile=str(template_1)):
-        sys.stdout.write(line + "\n")
 
-    exit(1)
+def cft_drift():
+    """Entrypoint to detect drift on many stacks at once."""
+    parser = argparse.ArgumentParser(description="Detect drift on stacks, printing a line of json per stack as it finishes. "
+                                     "Exits 1 if any stack has drifted or couldn't be checked")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--stack-name", help="Stackname(s) to check", nargs='+')
+    group.add_argument("--all", help="Check every stack in the region that is in a stable state", action='store_true')
+    parser.add_argument("--max-concurrency", help="Maximum number of drift detections to run at once", type=int, default=10)
+    parser.add_argument("--max-api-rate", help="Maximum API calls per second across all stacks", type=float, default=2)
+    parser.add_argument("--profile", help="Use the BOTO3 Profile")
+
+    args = do_args(parser)
+    import boto3
+    from .clients import get_session
+    from .stack import CFStack, CFStackDriftMonitor, StackDriftableStatus
+
+    if not args.profile:
+        session = get_session()
+    else:
+        session = boto3.session.Session(profile_name=args.profile)
+
+    if args.all:
+        stack_names = CFStack.list_stack_names(args.region, session=session, StackStatusFilter=StackDriftableStatus)
+    else:
+        stack_names = args.stack_name
+    logger.info(f"Detecting drift on {len(stack_names)} stacks in {args.region}")
+
+    monitor = CFStackDriftMonitor([CFStack(s, args.region, session=session) for s in stack_names],
+                                  max_concurrency=args.max_concurrency, rate=args.max_api_rate)
+    results = monitor.run(on_result=lambda stack, result: print(json.dumps(result, default=str), flush=True))
+
+    rc = 0
+    for stack_name, result in results.items():
+        if 'Error' in result or result['DetectionStatus'] != "DETECTION_COMPLETE" or result['StackDriftStatus'] == "DRIFTED":
+            rc = 1
+    drifted = [s for s, r in results.items() if r.get('StackDriftStatus') == "DRIFTED"]
+    logger.info(f"{len(drifted)} of {len(results)} stacks have drifted: {', '.join(drifted)}" if drifted else f"None of {len(results)} stacks have drifted")
+    exit(rc)
+
+
+def cft_purge_cache():
+    """Entrypoint to remove everything from the local cft-deploy cache."""
+    parser = argparse.ArgumentParser(description="Purge the local cft-deploy cache")
+    parser.add_argument("--cache-dir", help="Cache directory (defaults to $CFT_DEPLOY_CACHE_DIR or ~/.cache/cft-deploy)")
+    args = do_args(parser)
+    from .cache import purge_cache
+    count = purge_cache(args.cache_dir)
+    print(f"Removed {count} cache entries")
+    exit(0)
 
 
 def version():
@@ -464,8 +904,6 @@ def do_args(parser):
     ch.setFormatter(formatter)
     # add ch to logger
     logger.addHandler(ch)
-
-    logger.setLevel(logging.INFO)
     # Quiet Boto3
     logging.getLogger('botocore').setLevel(logging.WARNING)
     logging.getLogger('boto3').setLevel(logging.WARNING)
@@ -473,6 +911,59 @@ def do_args(parser):
     return(args)
 
 
+def add_validation_cache_args(parser):
+    """Add the options to use the local validation cache."""
+    parser.add_argument("--cache", help="Reuse the results of validating unchanged templates, cached locally", action='store_true')
+    parser.add_argument("--cache-ttl", help="Seconds before cached validation results expire", type=int, default=7 * 86400)
+    parser.add_argument("--cache-dir", help="Cache directory (defaults to $CFT_DEPLOY_CACHE_DIR or ~/.cache/cft-deploy)")
+
+
+def get_validation_cache(args):
+    """Return the ValidationCache requested by the options from add_validation_cache_args(), or None."""
+    if not args.cache:
+        return(None)
+    from .cache import ValidationCache
+    return(ValidationCache(cache_dir=args.cache_dir, ttl=args.cache_ttl))
+
+
+def add_cache_args(parser):
+    """Add the options to use the local stack cache."""
+    parser.add_argument("--cache", help="Cache the outputs, parameters & resources of other stacks locally", action='store_true')
+    parser.add_argument("--cache-ttl", help="Seconds before cached stacks are revalidated with AWS", type=int, default=3600)
+    parser.add_argument("--cache-dir", help="Cache directory (defaults to $CFT_DEPLOY_CACHE_DIR or ~/.cache/cft-deploy)")
+    parser.add_argument("--index", help="Look up other stacks in an index of the whole region, built with a few paginated calls. "
+                        "With --cache, the index is kept on disk", action='store_true')
+
+
+def add_staging_args(parser):
+    """Add the option to stage oversize templates in S3."""
+    parser.add_argument("--staging-bucket", help="Upload local templates too large to pass to CloudFormation to this bucket "
+                        "(defaults to the manifest's StagingBucket or $CFT_DEPLOY_STAGING_BUCKET)")
+
+
+def get_stack_cache(args, session=None, account=None):
+    """Return the StackCache (or CFStackIndex) requested by the options from add_cache_args(), or None.
+    As the caches are keyed by region, the caches on disk are kept apart for each partition and account: that of
+    session's credentials, or account (in the same partition) if it is given."""
+    from .cache import DiskCache, StackCache
+    if args.index:
+        from .index import CFStackIndex
+        disk_cache = None
+        if args.cache:
+            disk_cache = DiskCache(f"index-{get_cache_suffix(session, account)}", cache_dir=args.cache_dir, ttl=args.cache_ttl)
+        return(CFStackIndex(disk_cache=disk_cache))
+    if args.cache:
+        return(StackCache(cache_dir=args.cache_dir, ttl=args.cache_ttl, namespace=f"stacks-{get_cache_suffix(session, account)}"))
+    return(None)
+
+
+def get_cache_suffix(session=None, account=None):
+    """Return the partition-account suffix of the cache namespaces for session, or for account in session's partition."""
+    from .clients import get_caller_account
+    (partition, caller_account) = get_caller_account(session)
+    return(f"{partition}-{account if account is not None else caller_account}")
+
+
 def process_override_params(args):
     params = {}
     if not args.overrideparameters:
@@ -0,0 +1,188 @@
+from .stack import *
+from .concurrency import DEFAULT_MAX_WORKERS
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+
+import logging
+logger = logging.getLogger('cft-deploy.index')
+
+
+class CFStackIndex(object):
+    """Class to represent every live stack in a region, with its Parameters and Outputs, plus the region's exports.
+
+    A region is indexed the first time it is used, with a paginated describe_stacks (which, unlike list_stacks,
+    includes each stack's Parameters & Outputs) and a paginated list_exports: a handful of calls however many stacks
+    there are. If disk_cache (a DiskCache) is set, the index is persisted there and reused until it goes stale.
+
+    The index can be passed to CFStack, CFManifest or CFStack.get_many() in place of a StackCache.
+
+    find_resources() maps PhysicalResourceIds back to their stacks, listing the resources of each indexed stack
+    (at most once, in any status) rather than calling describe_stack_resources for every id.
+    """
+
+    def __init__(self, disk_cache=None):
+        self.disk_cache = disk_cache
+        # region -> {'stacks': {StackName: stack data}, 'exports': {Name: export}, 'resources': {StackName: resources},
+        #            'listed': {StackName: {LogicalResourceId: PhysicalResourceId}}}
+        # resources are kept for CFStack.get_resources() through store(), listed are every resource found by find_resources()
+        self.regions = {}
+        self.api_calls = 0
+        self.lock = threading.RLock()
+
+    def build(self, cf_client, region):
+        """(Re)Build the index for region using cf_client."""
+        logger.debug(f"Building the stack index for {region}")
+        stacks = {}
+        for page in cf_client.get_paginator('describe_stacks').paginate():
+            self.api_calls += 1
+            for s in page['Stacks']:
+                stacks[s['StackName']] = s
+        exports = {}
+        for page in cf_client.get_paginator('list_exports').paginate():
+            self.api_calls += 1
+            for e in page['Exports']:
+                exports[e['Name']] = e
+        logger.debug(f"Indexed {len(stacks)} stacks and {len(exports)} exports in {region} with {self.api_calls} API calls")
+
+        with self.lock:
+            self.regions[region] = {'stacks': stacks, 'exports': exports, 'resources': {}, 'listed': {}}
+            if self.disk_cache is not None:
+                self.disk_cache.put(region, {'stacks': stacks, 'exports': exports})
+        return(self.regions[region])
+
+    def get_region(self, cf_client, region):
+        """Return the index for region, loading it from disk or building it if needed."""
+        with self.lock:
+            if region not in self.regions:
+                data = self.disk_cache.get(region) if self.disk_cache is not None else None
+                if data is not None:
+                    logger.debug(f"Loaded the stack index for {region} from {self.disk_cache.path}")
+                    listed = self.disk_cache.get(self.resources_key(region)) or {}
+                    self.regions[region] = {'stacks': data['stacks'], 'exports': data['exports'], 'resources': {}, 'listed': listed}
+                else:
+                    self.build(cf_client, region)
+            return(self.regions[region])
+
+    def get_stack_data(self, cf_client, region, stack_name):
+        """Return the describe_stacks data for stack_name (or StackId) in region, or None if it isn't in the index."""
+        stacks = self.get_region(cf_client, region)['stacks']
+        if stack_name in stacks:
+            return(stacks[stack_name])
+        for s in stacks.values():
+            if s['StackId'] == stack_name:
+                return(s)
+        return(None)
+
+    def get_exports(self, cf_client, region):
+        """Return a dict of export Name to Value for region."""
+        return({k: v['Value'] for k, v in self.get_region(cf_client, region)['exports'].items()})
+
+    def lookup(self, stack):
+        """StackCache interface. Return the indexed data for the CFStack, or None to have it fetched from AWS."""
+        data = self.get_stack_data(stack.cf_client, stack.region, stack.stack_name)
+        if data is None:
+            logger.debug(f"{stack.stack_name} is not in the stack index for {stack.region}")
+            return(None)
+        with self.lock:
+            resources = self.regions[stack.region]['resources'].get(data['StackName'])
+        return({'StackData': data, 'Resources': resources})
+
+    def store(self, stack, resources=None):
+        """StackCache interface. Keep the stack's latest data (and resources) in the index."""
+        with self.lock:
+            if stack.region not in self.regions:
+                return
+            self.regions[stack.region]['stacks'][stack.stackData['StackName']] = stack.stackData
+            if resources is not None:
+                self.regions[stack.region]['resources'][stack.stackData['StackName']] = resources
+
+    def invalidate(self, region, stack_name):
+        """StackCache interface. Drop the stack, which is being deployed, from the index so the next lookup fetches it
+        from AWS. The index persisted for region is dropped too, to be rebuilt the next time it is loaded."""
+        with self.lock:
+            if region in self.regions:
+                for k in ['stacks', 'resources', 'listed']:
+                    self.regions[region][k].pop(stack_name, None)
+            if self.disk_cache is not None:
+                logger.debug(f"Invalidating the stack index for {region} as {stack_name} is being deployed")
+                self.disk_cache.delete(region)
+                self.disk_cache.delete(self.resources_key(region))
+
+    @classmethod
+    def resources_key(cls, region):
+        return(f"{region}/resources")
+
+    def get_physical_ids(self, region):
+        """Return a dict of PhysicalResourceId to (StackName, LogicalResourceId) from the resources listed so far."""
+        output = {}
+        with self.lock:
+            for stack_name, resources in self.regions[region]['listed'].items():
+                for logical_id, physical_id in resources.items():
+                    output.setdefault(physical_id, (stack_name, logical_id))
+        return(output)
+
+    def find_resources(self, physical_ids, region, session=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Find the stacks owning each of physical_ids. A generator of dicts of PhysicalResourceId, StackName,
+        StackId and LogicalResourceId, yielded as soon as each id is found; ids that aren't found are not yielded.
+
+        Ids already in the index are returned first. The resources of the other stacks are then listed in parallel,
+        and the scan stops once every id has been found. Once every stack has been listed, the resources are
+        persisted with the rest of the index.
+        """
+        session = get_session(session)
+        cf_client = get_client('cloudformation', region, session)
+        stacks = self.get_region(cf_client, region)['stacks']
+        wanted = set(physical_ids)
+
+        def _matches(found):
+            for physical_id in sorted(wanted & set(found)):
+                (stack_name, logical_id) = found[physical_id]
+                wanted.discard(physical_id)
+                yield({'PhysicalResourceId': physical_id, 'StackName': stack_name,
+                       'StackId': stacks[stack_name]['StackId'], 'LogicalResourceId': logical_id})
+
+        yield from _matches(self.get_physical_ids(region))
+        with self.lock:
+            unlisted = [n for n in stacks if n not in self.regions[region]['listed']]
+        if len(wanted) == 0 or len(unlisted) == 0:
+            return
+
+        logger.debug(f"Listing the resources of {len(unlisted)} stacks in {region} to find {len(wanted)} resources")
+        done = threading.Event()
+
+        def _list(stack_name):
+            """Return the LogicalResourceId to PhysicalResourceId of every resource in the stack, whatever its status."""
+            if done.is_set():
+                return(None)
+            resources = {}
+            try:
+                for page in cf_client.get_paginator('list_stack_resources').paginate(StackName=stacks[stack_name]['StackId']):
+                    with self.lock:
+                        self.api_calls += 1
+                    for r in page['StackResourceSummaries']:
+                        if 'PhysicalResourceId' in r:
+                            resources[r['LogicalResourceId']] = r['PhysicalResourceId']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationError':
+                    raise
+                logger.warning(f"Unable to list the resources of {stack_name}: {e}")
+            with self.lock:
+                self.regions[region]['listed'][stack_name] = resources
+            return(resources)
+
+        complete = True
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unlisted)))) as executor:
+            futures = {executor.submit(_list, n): n for n in unlisted}
+            for future in as_completed(futures):
+                resources = future.result()
+                if resources is None:
+                    complete = False
+                    continue
+                yield from _matches({physical_id: (futures[future], logical_id) for logical_id, physical_id in resources.items()})
+                if len(wanted) == 0:
+                    done.set()
+
+        if complete and self.disk_cache is not None:
+            with self.lock:
+                self.disk_cache.put(self.resources_key(region), self.regions[region]['listed'])
@@ -1,5 +1,7 @@
 from .template import *
 from .stack import *
+from .concurrency import DEFAULT_MAX_WORKERS, run_concurrently
+from .clients import get_client, get_session
 
 import boto3
 from botocore.exceptions import ClientError
@@ -8,6 +10,7 @@ import sys
 import json
 import yaml
 import re
+import hashlib
 
 import logging
 logger = logging.getLogger('cft-deploy.manifest')
@@ -16,14 +19,16 @@ logger = logging.getLogger('cft-deploy.manifest')
 class CFManifest(object):
     """Class to represent a CloudFormation Template"""
 
-    def __init__(self, manifest_filename, session=None, region=None):
-        """Constructs a CFManifest from the manifest file."""
+    def __init__(self, manifest_filename, session=None, region=None, cache=None, staging_bucket=None, skip_unchanged=False):
+        """Constructs a CFManifest from the manifest file.
+        If cache (a StackCache) is set, the DependentStacks are looked up through it.
+        An oversize LocalTemplate is staged to staging_bucket, the manifest's StagingBucket or $CFT_DEPLOY_STAGING_BUCKET.
+        If skip_unchanged is set, deploy() doesn't update a stack whose fingerprint() is the same as the payload's."""
         self.manifest_filename = manifest_filename
+        self.cache = cache
+        self.skip_unchanged = skip_unchanged
 
-        if session is None:
-            self.session = boto3.session.Session()
-        else:
-            self.session = session
+        self.session = get_session(session)
 
         # Read the file
         try:
@@ -44,10 +49,12 @@ class CFManifest(object):
             self.document['Region'] = region
 
         # create a CF Client in the correct region
-        self.cf_client = self.session.client('cloudformation', region_name=self.region)
+        self.cf_client = get_client('cloudformation', self.region, self.session)
 
+        if staging_bucket is None:
+            staging_bucket = self.document.get('StagingBucket')
         if 'LocalTemplate' in self.document:
-            self.template = CFTemplate.read(self.document['LocalTemplate'], self.region)
+            self.template = CFTemplate.read(self.document['LocalTemplate'], self.region, session=self.session, staging_bucket=staging_bucket)
         else:
             self.template = None
 
@@ -61,12 +68,14 @@ class CFManifest(object):
         try:
             self.fetch_parameters(override=override)
             payload = self.build_cft_payload()
+            payload['ClientRequestToken'] = new_client_request_token()
             stack_response = self.cf_client.create_stack(**payload)
             if 'StackId' not in stack_response:
                 logger.error("Unable to create stack")
                 return(None)
             else:
                 my_new_stack = CFStack(self.stack_name, self.region, self.session)
+                my_new_stack.client_request_token = payload['ClientRequestToken']
                 return(my_new_stack)
         except CFStackDoesNotExistError as e:
             logger.error(f"Could not find new stack {self.stack_name} in {self.region}: {e}")
@@ -75,6 +84,106 @@ class CFManifest(object):
             logger.error(f"Error attempting to create {self.stack_name} in {self.region}: {e}")
             return(None)
 
+    def deploy(self, override=None, force=False):
+        """Create the stack if it doesn't exist, otherwise update it.
+        Returns the CFStack being deployed, or None on failure. The stack's operation attribute is set to
+        CREATE, UPDATE or NOOP (when there were no updates to be performed).
+        """
+        my_stack = CFStack(self.stack_name, self.region, session=self.session)
+        try:
+            if my_stack.get() is None:
+                logger.error(f"Cannot find a stack named {self.stack_name}")
+                return(None)
+        except CFStackDoesNotExistError as e:
+            logger.info(e)
+            # Then we're creating the stack
+            my_stack = self.create_stack(override=override)
+            if my_stack is None:
+                logger.error(f"Failed to Create stack {self.stack_name} in {self.region}")
+                return(None)
+            self.invalidate_cache()
+            my_stack.get()
+            my_stack.operation = "CREATE"
+            return(my_stack)
+
+        # Only if the stack is in a normal status (or force is specified) do we update
+        status = my_stack.StackStatus
+        if status not in StackGoodStatus and force is not True:
+            logger.error(f"Stack {self.stack_name} is in status {status} and force was not specified. Aborting....")
+            return(None)
+
+        if self.skip_unchanged and status in StackGoodStatus:
+            self.fetch_parameters(override=override)
+            fingerprint = self.fingerprint()
+            if fingerprint is not None and self.deployed_fingerprint(my_stack) == fingerprint:
+                logger.info(f"{self.stack_name} in {self.region} was already deployed with this payload. No updates to be performed")
+                my_stack.operation = "NOOP"
+                return(my_stack)
+            rc = my_stack.update(payload=self.build_cft_payload())
+        else:
+            rc = my_stack.update(manifest=self, override=override)
+        if rc is None:
+            logger.error(f"Failed to Update stack {self.stack_name} in {self.region}")
+            return(None)
+        my_stack.operation = "NOOP" if rc is True else "UPDATE"
+        if my_stack.operation == "UPDATE":
+            self.invalidate_cache()
+        return(my_stack)
+
+    def create_changeset(self, changeset_name=None, override=None):
+        """Create a change set for this manifest: an UPDATE change set if the stack exists, otherwise a CREATE one.
+        Returns the CFStack, with its changeset_name, changeset_type and changeset_id set, or None on failure."""
+        if changeset_name is None:
+            changeset_name = new_client_request_token()
+        my_stack = CFStack(self.stack_name, self.region, session=self.session)
+        changeset_type = "UPDATE"
+        try:
+            my_stack.get()
+            # A stack whose CREATE change set was never executed still has to be created by one
+            if my_stack.StackStatus == "REVIEW_IN_PROGRESS":
+                changeset_type = "CREATE"
+        except CFStackDoesNotExistError:
+            changeset_type = "CREATE"
+
+        try:
+            my_stack.create_changeset(changeset_name, manifest=self, override=override, ChangeSetType=changeset_type)
+            return(my_stack)
+        except ClientError as e:
+            logger.error(f"Error attempting to create a change set for {self.stack_name} in {self.region}: {e}")
+            return(None)
+
+    def execute_changeset(self, my_stack):
+        """Execute the change set from create_changeset(). The manifest's StackPolicy and TerminationProtection aren't
+        part of a change set, so they are applied to the stack first. (OnFailure is part of a CREATE change set, and
+        TimeoutInMinutes can't be set, see CFStack.create_changeset().)"""
+        payload = self.build_cft_payload()
+        try:
+            if 'StackPolicyBody' in payload:
+                self.cf_client.set_stack_policy(StackName=my_stack.StackId, StackPolicyBody=payload['StackPolicyBody'])
+            if 'EnableTerminationProtection' in payload:
+                self.cf_client.update_termination_protection(StackName=my_stack.StackId,
+                                                             EnableTerminationProtection=payload['EnableTerminationProtection'])
+        except ClientError as e:
+            logger.warning(f"Unable to apply the stack policy or termination protection to {self.stack_name}: {e}")
+        my_stack.execute_changeset()
+        self.invalidate_cache()
+        my_stack.operation = my_stack.changeset_type
+        return(my_stack)
+
+    def invalidate_cache(self):
+        """Drop this manifest's stack from the cache, as its Outputs (and Parameters) change when it is deployed.
+        deploy() and execute_changeset() call this as the operation starts; call it again once it has finished, in
+        case the stack was looked up (and cached) while the operation was still running."""
+        if self.cache is not None:
+            self.cache.invalidate(self.region, self.stack_name)
+
+    def discard_changeset(self, my_stack):
+        """Delete the change set from create_changeset(), and for a CREATE change set, the empty stack it created."""
+        if my_stack.changeset_type == "CREATE":
+            my_stack.delete()
+        else:
+            my_stack.delete_changeset()
+
     def validate(self, override=None):
         """Validate the template's syntax by sending to CloudFormation Service. Returns json from AWS."""
 
@@ -87,11 +196,14 @@ class CFManifest(object):
         payload = self.build_cft_payload()
         return(payload)
 
-    def fetch_parameters(self, override=None):
-        """Based on the manifest's Sourced Parameters, find all the parameters and populate them."""
+    def fetch_parameters(self, override=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Based on the manifest's Sourced Parameters, find all the parameters and populate them.
+        Dependent stacks are fetched in parallel on a pool of at most max_workers threads.
+        """
 
         param_dict = {}  # we add all the parameters to this dictionary to de-dupe them
         stack_map = {}
+        self.lookup_stats = None
 
         if self.document['Parameters'] is not None:
             # Start with the regular parameters from the Manifest
@@ -115,52 +227,49 @@ class CFManifest(object):
             logger.critical("DependsOnStacks Not yet implemented")
             raise NotImplementedError
 
-        try:
-            if 'DependentStacks' in self.document and self.document['DependentStacks'] is not None:
-                # The new way
-                for source_key, source_stack_name in self.document['DependentStacks'].items():
-                    my_stack = CFStack(source_stack_name, self.region, self.session)
-                    if my_stack is None or my_stack.get() is None:
+        if 'DependentStacks' in self.document and self.document['DependentStacks'] is not None:
+            # The new way
+            # The describe_stacks calls are made in parallel, and the results are walked in manifest order so
+            # the first failing dependent stack is always the one reported.
+            dependents = [(source_key, CFStack(source_stack_name, self.region, self.session, cache=self.cache))
+                          for source_key, source_stack_name in self.document['DependentStacks'].items()]
+            results = run_concurrently(lambda d: d[1].get_cached(), dependents, max_workers=max_workers)
+            for (source_key, my_stack), stack_id, error in results:
+                source_stack_name = my_stack.stack_name
+                try:
+                    if error is not None:
+                        raise error
+                    if stack_id is None:
                         logger.error(f"Creating stack object for {source_stack_name} returned None")
                         raise CFStackDoesNotExistError(source_stack_name)
                     stack_map[source_key] = my_stack
-        except CFStackDoesNotExistError as e:
-            logger.critical(f"Could not find dependent stack {source_stack_name} in {self.region}: {e}")
-            raise
-        except ClientError as e:
-            logger.critical(f"Error attempting to create {self.stack_name} in {self.region}: {e}")
-            raise
+                except CFStackDoesNotExistError as e:
+                    logger.critical(f"Could not find dependent stack {source_stack_name} in {self.region}: {e}")
+                    raise
+                except ClientError as e:
+                    logger.critical(f"Error attempting to create {self.stack_name} in {self.region}: {e}")
+                    raise
 
         if 'SourcedParameters' in self.document and self.document['SourcedParameters'] is not None:
+            lookup = StackLookup(stack_map, max_workers=max_workers)
+            lookup.prefetch(self.document['SourcedParameters'])
             for k, v in self.document['SourcedParameters'].items():
                 (stack_map_key, section, resource_id) = v.split('.')
                 if stack_map_key not in stack_map:
                     logger.error(f"DependentStack {stack_map_key} was required by {k} but was not found or referenced.")
                     continue
-                source_stack = stack_map[stack_map_key]
-                if section == "Parameters":
-                    params = source_stack.get_parameters()
-                    if resource_id in params:
-                        param_dict[k] = {'ParameterKey': k, 'ParameterValue': params[resource_id], 'UsePreviousValue': False}
-                    else:
-                        logger.error(f"Unable to find {resource_id} in {source_stack.stack_name} (aliased as {stack_map_key}) Parameters")
-                        raise StackLookupException
-                elif section == "Outputs":
-                    outputs = source_stack.get_outputs()
-                    if resource_id in outputs:
-                        param_dict[k] = {'ParameterKey': k, 'ParameterValue': outputs[resource_id], 'UsePreviousValue': False}
-                    else:
-                        logger.error(f"Unable to find {resource_id} in {source_stack.stack_name} (aliased as {stack_map_key}) Outputs")
-                        raise StackLookupException
-                elif section == "Resources":
-                    resources = source_stack.get_resources()
-                    if resource_id in resources:
-                        param_dict[k] = {'ParameterKey': k, 'ParameterValue': resources[resource_id], 'UsePreviousValue': False}
-                    else:
-                        logger.error(f"Unable to find {resource_id} in {source_stack.stack_name} (aliased as {stack_map_key}) Resources")
-                        raise StackLookupException
-                else:
+                if section not in StackLookup.Sections:
                     logger.error(f"Invaluid SourcedParameters section type: {section}")
+                    continue
+                values = lookup.get_section(stack_map_key, section)
+                if resource_id in values:
+                    param_dict[k] = {'ParameterKey': k, 'ParameterValue': values[resource_id], 'UsePreviousValue': False}
+                else:
+                    logger.error(f"Unable to find {resource_id} in {stack_map[stack_map_key].stack_name} (aliased as {stack_map_key}) {section}")
+                    raise StackLookupException
+            self.lookup_stats = lookup.stats(self.document['SourcedParameters'])
+            logger.info(f"Resolved SourcedParameters from {len(stack_map)} dependent stacks with {self.lookup_stats['api_calls']} API calls "
+                        f"(a per-parameter lookup would have made {self.lookup_stats['naive_api_calls']})")
 
         # Finally, any parameters passed in as an override take precedence
         if override is not None:
@@ -174,8 +283,9 @@ class CFManifest(object):
 
         return(True)
 
-    def build_cft_payload(self):
-        """Generate the CFT Payload"""
+    def build_cft_payload(self, include_template=True):
+        """Generate the CFT Payload. If include_template is False, the TemplateBody or TemplateURL is left out (so the
+        template isn't staged)."""
         stack_policy_body = {
             'Statement': self.document['StackPolicy']
         }
@@ -199,13 +309,13 @@ class CFManifest(object):
             payload['StackPolicyBody'] = json.dumps(stack_policy_body)
 
         # Now make the decision on what to tell CF about the template
-        if 'LocalTemplate' in self.document:
-            payload['TemplateBody'] = self.template.template_body
-        elif 'S3Template' in self.document:
-            payload['TemplateURL'] = self.document['S3Template']
-        else:
+        if 'LocalTemplate' not in self.document and 'S3Template' not in self.document:
             logger.critical("Neither 'TemplateBody' nor 'TemplateURL' found in manifest")
             return(False)
+        if include_template and 'LocalTemplate' in self.document:
+            payload.update(self.template.template_args())
+        elif include_template:
+            payload['TemplateURL'] = self.document['S3Template']
 
         # format and add the tags
         if 'Tags' in self.document:
@@ -214,16 +324,155 @@ class CFManifest(object):
 
         return(payload)
 
+    def fingerprint(self):
+        """Return the sha256 (hex) of everything in the payload an update would change: the parsed template, the
+        Parameters (including those left to their template Default), Tags and StackPolicyBody. The parameters must
+        already be fetched. See deployed_fingerprint().
+
+        As an S3Template can change without its url changing, there is no fingerprint for it and None is returned, as
+        it is if the template can't be parsed.
+        """
+        if 'LocalTemplate' not in self.document:
+            return(None)
+        payload = self.build_cft_payload(include_template=False)
+        if payload is False:
+            return(None)
+        try:
+            document = self.template.parse()
+        except (ValueError, yaml.YAMLError) as e:
+            logger.warning(f"Unable to parse {self.template} to fingerprint it: {e}")
+            return(None)
+        params = {}
+        for k, v in (document.get('Parameters') or {}).items():
+            if isinstance(v, dict) and 'Default' in v:
+                params[k] = ",".join(str(d) for d in v['Default']) if isinstance(v['Default'], list) else str(v['Default'])
+        params.update({p['ParameterKey']: p['ParameterValue'] for p in self.params})
+        stack_policy = json.loads(payload['StackPolicyBody']) if 'StackPolicyBody' in payload else None
+        return(fingerprint_stack(document, params, {t['Key']: t['Value'] for t in payload['Tags']}, stack_policy))
+
+    def deployed_fingerprint(self, my_stack):
+        """Return the fingerprint() of the stack as it is deployed, from its original template, Parameters, Tags and
+        (if this manifest has a StackPolicy, as an update without one leaves the stack's policy as it is) stack policy.
+        NoEcho parameters are masked by CloudFormation, so a stack with them never matches. Returns None if the
+        deployed template can't be parsed."""
+        try:
+            document = my_stack.get_template().parse()
+        except (ValueError, yaml.YAMLError) as e:
+            logger.warning(f"Unable to parse the template of {self.stack_name} to fingerprint it: {e}")
+            return(None)
+        stack_policy = None
+        if 'StackPolicy' in self.document:
+            response = self.cf_client.get_stack_policy(StackName=my_stack.StackId)
+            stack_policy = json.loads(response['StackPolicyBody']) if 'StackPolicyBody' in response else None
+        tags = {k: v for k, v in my_stack.get_tags(refresh=False).items() if not k.startswith("aws:")}
+        # The ParameterValue, as passed in the payload, rather than the ResolvedValue of SSM parameters
+        params = {p['ParameterKey']: p.get('ParameterValue') for p in my_stack.stackData.get('Parameters', [])}
+        return(fingerprint_stack(document, params, tags, stack_policy))
+
     def estimate_cost(self):
         """Return a url to the simple monthly cost estimator for this template / parameter set."""
         self.fetch_parameters()
+        if 'LocalTemplate' in self.document:
+            template_args = self.template.template_args()
+        else:
+            template_args = {'TemplateURL': self.document['S3Template']}
         response = self.cf_client.estimate_template_cost(
-            TemplateBody=self.template.template_body,
-            Parameters=self.params
+            Parameters=self.params,
+            **template_args
         )
         return(response['Url'])
 
 
+def fingerprint_stack(template_document, params, tags, stack_policy):
+    """Return the sha256 (hex) of a stack's parsed template, dict of parameter values, dict of tags and stack policy."""
+    canonical = {
+        'Template':     template_document,
+        'Parameters':   params,
+        'Tags':         tags,
+        'StackPolicy':  stack_policy,
+    }
+    return(hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode("utf-8")).hexdigest())
+
+
+class StackLookup(object):
+    """Per-run cache of the dependent stacks referenced by a manifest's SourcedParameters.
+
+    Each dependent stack's description (Parameters & Outputs) and resource list are fetched at most once,
+    no matter how many SourcedParameters reference them.
+    """
+
+    Sections = ["Parameters", "Outputs", "Resources"]
+
+    def __init__(self, stack_map, max_workers=DEFAULT_MAX_WORKERS):
+        """stack_map is the dict of DependentStacks alias to CFStack. Each CFStack must already have had get() called."""
+        self.stack_map = stack_map
+        self.max_workers = max_workers
+        self.sections = {}
+        # Building the stack_map cost one describe_stacks per dependent stack not found in the cache
+        self.api_calls = len([s for s in stack_map.values() if not s.from_cache])
+
+    @classmethod
+    def group_keys(cls, sourced_parameters):
+        """Group the SourcedParameters by (stack_map_key, section). Returns a dict of (stack_map_key, section) to {ParameterKey: resource_id}."""
+        groups = {}
+        for k, v in sourced_parameters.items():
+            (stack_map_key, section, resource_id) = v.split('.')
+            groups.setdefault((stack_map_key, section), {})[k] = resource_id
+        return(groups)
+
+    def prefetch(self, sourced_parameters):
+        """Fetch every (stack, section) pair referenced by sourced_parameters in parallel, skipping unknown stacks or sections.
+        If any fetch fails, the error for the first pair in manifest order is raised.
+        """
+        pairs = [(stack_map_key, section) for (stack_map_key, section) in self.group_keys(sourced_parameters)
+                 if stack_map_key in self.stack_map and section in self.Sections and (stack_map_key, section) not in self.sections]
+        results = run_concurrently(lambda pair: self._fetch_section(*pair), pairs, max_workers=self.max_workers)
+        for pair, values, error in results:
+            if error is not None:
+                raise error
+            self._store_section(pair, values)
+
+    def get_section(self, stack_map_key, section):
+        """Return the dict of values for this section of the dependent stack, fetching it from AWS only the first time."""
+        if (stack_map_key, section) not in self.sections:
+            self._store_section((stack_map_key, section), self._fetch_section(stack_map_key, section))
+        return(self.sections[(stack_map_key, section)])
+
+    def _fetch_section(self, stack_map_key, section):
+        source_stack = self.stack_map[stack_map_key]
+        if section == "Parameters":
+            return(source_stack.get_parameters(refresh=False))
+        elif section == "Outputs":
+            return(source_stack.get_outputs(refresh=False))
+        elif section == "Resources":
+            return(source_stack.get_resources())
+        else:
+            raise ValueError(f"Invalid SourcedParameters section type: {section}")
+
+    def _store_section(self, pair, values):
+        (stack_map_key, section) = pair
+        if section == "Resources":
+            self.api_calls += self.stack_map[stack_map_key].resource_pages
+        self.sections[pair] = values
+
+    def stats(self, sourced_parameters):
+        """Return the number of API calls made, and the number a lookup per SourcedParameter would have made."""
+        naive = len(self.stack_map)
+        for (stack_map_key, section), keys in self.group_keys(sourced_parameters).items():
+            if (stack_map_key, section) not in self.sections:
+                continue
+            if section == "Resources":
+                naive += len(keys) * self.stack_map[stack_map_key].resource_pages
+            else:
+                naive += len(keys)
+        return({
+            'dependent_stacks': len(self.stack_map),
+            'sections_fetched': len(self.sections),
+            'api_calls': self.api_calls,
+            'naive_api_calls': naive,
+        })
+
+
 class StackLookupException(Exception):
     """Thrown when the cross-stack lookup fails to find a specified Resource, Parameter or Output"""
     pass
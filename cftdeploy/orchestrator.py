@@ -0,0 +1,315 @@
+from .manifest import *
+from .stack import *
+from .concurrency import TokenBucket, run_concurrently
+from .clients import assume_role, get_client, get_session
+
+import boto3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import heapq
+import time
+import yaml
+
+import logging
+logger = logging.getLogger('cft-deploy.orchestrator')
+
+
+# Statuses given to stacks in the plan that never reach CloudFormation
+DeployFailed  = "FAILED"
+DeploySkipped = "SKIPPED"
+
+
+class CFDeployPlan(object):
+    """Class to represent a set of manifests, deployed in waves ordered by the DependentStacks between them."""
+
+    def __init__(self, manifest_filenames, session=None, region=None, profile=None, staging_bucket=None, skip_unchanged=False,
+                 cache=None):
+        """Reads every manifest and builds the dependency graph between them.
+        DependentStacks that aren't deployed by one of these manifests are expected to already exist, and are looked
+        up through cache (a StackCache or CFStackIndex) if it is set.
+        If skip_unchanged is set, stacks already deployed with the same payload aren't updated (see CFManifest).
+        """
+        if session is None and profile is not None:
+            session = boto3.session.Session(profile_name=profile)
+        self.session = get_session(session)
+
+        self.manifests = {}
+        for manifest_filename in manifest_filenames:
+            my_manifest = CFManifest(manifest_filename, session=self.session, region=region, staging_bucket=staging_bucket,
+                                     skip_unchanged=skip_unchanged, cache=cache)
+            if my_manifest.stack_name in self.manifests:
+                raise CFDeployPlanError(f"{my_manifest.stack_name} is deployed by both {manifest_filename} and "
+                                        f"{self.manifests[my_manifest.stack_name].manifest_filename}")
+            self.manifests[my_manifest.stack_name] = my_manifest
+
+        # stack_name -> set of stack_names in this plan it depends on
+        self.dependencies = {}
+        for stack_name, my_manifest in self.manifests.items():
+            dependent_stacks = my_manifest.document.get('DependentStacks') or {}
+            self.dependencies[stack_name] = set(s for s in dependent_stacks.values() if s in self.manifests)
+
+    def waves(self):
+        """Return the stack names grouped into waves. Every stack only depends on stacks in earlier waves."""
+        remaining = {k: set(v) for k, v in self.dependencies.items()}
+        waves = []
+        while len(remaining) > 0:
+            wave = sorted(k for k, v in remaining.items() if len(v) == 0)
+            if len(wave) == 0:
+                raise CFDeployPlanError(f"Circular DependentStacks between {', '.join(sorted(remaining))}")
+            waves.append(wave)
+            for stack_name in wave:
+                del remaining[stack_name]
+            for v in remaining.values():
+                v.difference_update(wave)
+        return(waves)
+
+    def deploy(self, max_concurrency=4, override=None, force=False, on_events=None, max_api_rate=2):
+        """Deploy every stack, wave by wave, with at most max_concurrency stacks in flight.
+
+        A stack that fails to deploy stops only the stacks that depend on it (directly or not), which are SKIPPED.
+        on_events(stack, events) is called with each batch of new stack events. Event polling for all the stacks in
+        flight shares a budget of max_api_rate calls per second.
+        Returns a dict of stack_name to final status: the StackStatus, FAILED or SKIPPED.
+        """
+        self.results = {}
+        self.bucket = TokenBucket(max_api_rate)
+        waves = self.waves()
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for i, wave in enumerate(waves, start=1):
+                ready = []
+                for stack_name in wave:
+                    failed_deps = [d for d in self.dependencies[stack_name] if self.results[d] not in StackGoodStatus]
+                    if len(failed_deps) > 0:
+                        logger.error(f"Skipping {stack_name} because {', '.join(sorted(failed_deps))} did not deploy")
+                        self.results[stack_name] = DeploySkipped
+                    else:
+                        ready.append(stack_name)
+                logger.info(f"Wave {i} of {len(waves)}: deploying {', '.join(ready) if ready else 'nothing'}")
+                futures = {stack_name: executor.submit(self._deploy_stack, self.manifests[stack_name], override, force, on_events)
+                           for stack_name in ready}
+                for stack_name, future in futures.items():
+                    self.results[stack_name] = future.result()
+        return(self.results)
+
+    def _deploy_stack(self, my_manifest, override, force, on_events):
+        """Deploy one manifest and wait for the stack to settle. Returns the final status."""
+        try:
+            my_stack = my_manifest.deploy(override=override, force=force)
+            if my_stack is None:
+                return(DeployFailed)
+            if my_stack.operation == "NOOP":
+                return(my_stack.StackStatus)
+
+            watcher = CFStackWatcher(my_stack, client_request_token=my_stack.client_request_token, bucket=self.bucket)
+            status = watcher.wait(on_events=on_events)
+            my_manifest.invalidate_cache()
+            return(status)
+        except Exception as e:
+            logger.error(f"Error deploying {my_manifest.stack_name} from {my_manifest.manifest_filename}: {e}")
+            return(DeployFailed)
+
+    def preview(self, max_concurrency=8, override=None, max_api_rate=2, keep=False):
+        """Create a change set for every stack at once and report what each would change, without executing any.
+
+        Change sets are created on a pool of max_concurrency threads, then all of them are polled from a single
+        scheduler that backs off while each is still being created, sharing a budget of max_api_rate calls per
+        second. Unless keep is set, the change sets are then deleted (along with the empty stacks made by CREATE
+        change sets). As stacks aren't deployed, stacks that depend on other stacks in the plan are previewed against
+        those stacks as they are now.
+
+        Returns a report: a dict of Stacks, a list with a dict per stack (in plan order) of the change set and its
+        resource Changes (see CFStack.summarize_changes()), and Summary, the counts of each kind of change.
+        """
+        self.bucket = TokenBucket(max_api_rate)
+        manifests = list(self.manifests.values())
+        created = run_concurrently(lambda m: m.create_changeset(override=override), manifests,
+                                   max_workers=max_concurrency)
+
+        reports = {}
+        schedule = []  # heap of (when to poll next, tie-breaker, interval, manifest, stack)
+        for i, (my_manifest, my_stack, e) in enumerate(created):
+            report = {'StackName': my_manifest.stack_name, 'Region': my_manifest.region, 'Manifest': my_manifest.manifest_filename}
+            reports[my_manifest.stack_name] = report
+            if e is not None or my_stack is None:
+                report['Error'] = str(e) if e is not None else "Unable to create the change set"
+                continue
+            report.update({'ChangeSetName': my_stack.changeset_name, 'ChangeSetType': my_stack.changeset_type})
+            heapq.heappush(schedule, (time.monotonic() + 1, i, 1, my_manifest, my_stack))
+
+        while len(schedule) > 0:
+            (due, i, interval, my_manifest, my_stack) = heapq.heappop(schedule)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            report = reports[my_manifest.stack_name]
+            try:
+                self.bucket.acquire()
+                status = my_stack.get_changeset_status()
+                if status['Status'] not in ChangeSetDoneStatus:
+                    interval = min(10, interval * 1.5)
+                    heapq.heappush(schedule, (time.monotonic() + interval, i, interval, my_manifest, my_stack))
+                    continue
+                report['Status'] = status['Status']
+                report['StatusReason'] = status['StatusReason']
+                report['Changes'] = []
+                if status['Status'] == "FAILED" and not CFStack.changeset_is_empty(status):
+                    report['Error'] = status['StatusReason']
+                if status['Status'] == "CREATE_COMPLETE":
+                    self.bucket.acquire()
+                    report['Changes'] = CFStack.summarize_changes(my_stack.describe_changeset()['Changes'])
+                if not keep:
+                    self.bucket.acquire()
+                    my_manifest.discard_changeset(my_stack)
+            except ClientError as e:
+                report['Error'] = str(e)
+            logger.info(f"Change set for {my_manifest.stack_name}: {report.get('Status', 'ERROR')} with {len(report.get('Changes', []))} changes")
+
+        stacks = [reports[m.stack_name] for m in manifests]
+        changes = [c for r in stacks for c in r.get('Changes', [])]
+        summary = {
+            'Stacks': len(stacks),
+            'StacksWithChanges': len([r for r in stacks if len(r.get('Changes', [])) > 0]),
+            'Errors': len([r for r in stacks if 'Error' in r]),
+            'Additions': len([c for c in changes if c['Action'] == "Add"]),
+            'Modifications': len([c for c in changes if c['Action'] == "Modify"]),
+            'Removals': len([c for c in changes if c['Action'] == "Remove"]),
+            'Replacements': len([c for c in changes if c['Replacement'] == "True"]),
+            'ConditionalReplacements': len([c for c in changes if c['Replacement'] == "Conditional"]),
+        }
+        return({'Stacks': stacks, 'Summary': summary})
+
+
+class CFRegionalDeploy(object):
+    """Class to represent a set of manifests deployed into many regions at once, as a CFDeployPlan per region.
+    Each region's manifests resolve their DependentStacks in that region."""
+
+    def __init__(self, manifest_filenames, regions, session=None, profile=None, staging_bucket=None, skip_unchanged=False,
+                 cache=None):
+        """Reads the manifests once for each region (see CFDeployPlan). The regions share cache, which is keyed by region."""
+        if session is None and profile is not None:
+            session = boto3.session.Session(profile_name=profile)
+        self.session = get_session(session)
+        self.regions = list(regions)
+        self.plans = {region: CFDeployPlan(manifest_filenames, session=self.session, region=region, staging_bucket=staging_bucket,
+                                           skip_unchanged=skip_unchanged, cache=cache)
+                      for region in self.regions}
+
+    @classmethod
+    def enabled_regions(cls, session=None, region=None):
+        """Return the names of the regions enabled in the account, sorted."""
+        ec2_client = get_client('ec2', region, get_session(session))
+        return(sorted(r['RegionName'] for r in ec2_client.describe_regions()['Regions']))
+
+    def deploy(self, max_regions=8, max_concurrency=4, override=None, force=False, on_events=None, max_api_rate=2, on_result=None):
+        """Deploy the plan in every region, up to max_regions at once.
+
+        Within each region the stacks are deployed as by CFDeployPlan.deploy(), with at most max_concurrency stacks
+        in flight and a budget of max_api_rate calls per second (as the API limits are per region).
+        on_events(region, stack, events) is called with each batch of new stack events, and on_result(region, results)
+        as each region finishes. Returns a dict of region to its dict of stack_name to final status.
+        """
+        def _deploy(region):
+            plan = self.plans[region]
+            region_events = None if on_events is None else (lambda stack, events: on_events(region, stack, events))
+            try:
+                results = plan.deploy(max_concurrency=max_concurrency, override=override, force=force, on_events=region_events,
+                                      max_api_rate=max_api_rate)
+            except Exception as e:
+                logger.error(f"Error deploying to {region}: {e}")
+                results = {stack_name: DeployFailed for stack_name in plan.manifests}
+            if on_result is not None:
+                on_result(region, results)
+            return(results)
+
+        self.results = {region: results for region, results, e in run_concurrently(_deploy, self.regions, max_workers=max_regions)}
+        return(self.results)
+
+
+class CFAccountDeploy(object):
+    """Class to represent a set of manifests deployed into many accounts, through a role assumed in each of them."""
+
+    def __init__(self, manifest_filenames, accounts, role_name, session=None, profile=None, region=None, staging_bucket=None,
+                 skip_unchanged=False, partition="aws", get_cache=None):
+        """The roles are only assumed (and the manifests read) as each account is deployed.
+        session (or profile) is the session the roles are assumed from. If get_cache is set, it is called with each
+        account to return the StackCache (or CFStackIndex) to use in it, as caches are keyed by region."""
+        if session is None and profile is not None:
+            session = boto3.session.Session(profile_name=profile)
+        self.session = get_session(session)
+        self.manifest_filenames = list(manifest_filenames)
+        self.accounts = list(accounts)
+        self.role_name = role_name
+        self.region = region
+        self.staging_bucket = staging_bucket
+        self.skip_unchanged = skip_unchanged
+        self.partition = partition
+        self.get_cache = get_cache
+
+        # The stack names, to report on accounts that fail before (or are skipped instead of) reading the manifests
+        self.stack_names = []
+        for manifest_filename in self.manifest_filenames:
+            with open(manifest_filename, 'r') as stream:
+                self.stack_names.append(yaml.safe_load(stream)['StackName'])
+
+    def role_arn(self, account):
+        """Return the arn of the role to assume in account."""
+        return(f"arn:{self.partition}:iam::{account}:role/{self.role_name}")
+
+    def plan(self, account):
+        """Assume the role in account and return the CFDeployPlan of the manifests in it."""
+        account_session = assume_role(self.role_arn(account), session=self.session)
+        return(CFDeployPlan(self.manifest_filenames, session=account_session, region=self.region, staging_bucket=self.staging_bucket,
+                            skip_unchanged=self.skip_unchanged, cache=self.get_cache(account) if self.get_cache else None))
+
+    def deploy(self, max_accounts=8, max_concurrency=4, override=None, force=False, on_events=None, max_api_rate=2,
+               on_result=None, failure_tolerance=0):
+        """Deploy the manifests into every account, up to max_accounts at once.
+
+        Within each account the stacks are deployed as by CFDeployPlan.deploy(). on_events(account, stack, events) is
+        called with each batch of new stack events, and on_result(account, results) as each account finishes.
+        An account fails if its role can't be assumed or any of its stacks didn't deploy. Once more than
+        failure_tolerance accounts have failed, no more accounts are started (those in flight are finished) and the
+        stacks of the rest are SKIPPED. Returns a dict of account to its dict of stack_name to final status.
+        """
+        def _deploy(account):
+            account_events = None if on_events is None else (lambda stack, events: on_events(account, stack, events))
+            try:
+                plan = self.plan(account)
+                return(plan.deploy(max_concurrency=max_concurrency, override=override, force=force, on_events=account_events,
+                                   max_api_rate=max_api_rate))
+            except Exception as e:
+                logger.error(f"Error deploying to {account}: {e}")
+                return({stack_name: DeployFailed for stack_name in self.stack_names})
+
+        self.results = {}
+        failures = 0
+        pending = list(self.accounts)
+        with ThreadPoolExecutor(max_workers=max(1, max_accounts)) as executor:
+            in_flight = {}
+            while True:
+                while len(pending) > 0 and len(in_flight) < max_accounts and failures <= failure_tolerance:
+                    account = pending.pop(0)
+                    in_flight[executor.submit(_deploy, account)] = account
+                if len(in_flight) == 0:
+                    break
+                (done, not_done) = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    account = in_flight.pop(future)
+                    self.results[account] = future.result()
+                    if any(status not in StackGoodStatus for status in self.results[account].values()):
+                        failures += 1
+                    if on_result is not None:
+                        on_result(account, self.results[account])
+
+        if len(pending) > 0:
+            logger.error(f"{failures} accounts failed, over the failure tolerance of {failure_tolerance}. "
+                         f"Skipping {len(pending)} accounts")
+        for account in pending:
+            self.results[account] = {stack_name: DeploySkipped for stack_name in self.stack_names}
+            if on_result is not None:
+                on_result(account, self.results[account])
+        return({account: self.results[account] for account in self.accounts})
+
+
+class CFDeployPlanError(Exception):
+    """Thrown when a set of manifests can't be ordered into a deployment plan"""
+    pass
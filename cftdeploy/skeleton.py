@@ -16,6 +16,8 @@ OnFailure: DO_NOTHING # accepts DO_NOTHING, ROLLBACK, DELETE
 
 # You must specify LocalTemplate or S3Template but not both.
 {template_line}
+# A LocalTemplate larger than CloudFormation's 51,200 byte limit is uploaded to this bucket and deployed from there
+# StagingBucket: my-bucket
 
 # Parameters:
 # There are two kinds of parameters, regular and sourced.
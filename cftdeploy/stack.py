@@ -5,9 +5,14 @@ import os
 import sys
 import json
 import datetime
-import dateutil.parser
+import collections
+import heapq
+import time
+import uuid
 
 from .template import *
+from .concurrency import DEFAULT_MAX_WORKERS, TokenBucket, run_concurrently
+from .clients import get_client, get_session
 
 import logging
 logger = logging.getLogger('cft-deploy.stack')
@@ -19,25 +24,39 @@ ResourceBadStatus       = ["CREATE_FAILED", "DELETE_IN_PROGRESS", "DELETE_FAILED
 ResourceTempStatus      = ["CREATE_IN_PROGRESS", "UPDATE_IN_PROGRESS"]
 StackTempStatus         = ["N/A", "CREATE_IN_PROGRESS", "ROLLBACK_IN_PROGRESS", "DELETE_IN_PROGRESS", "UPDATE_IN_PROGRESS",
                            "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS", "UPDATE_ROLLBACK_IN_PROGRESS",
-                           "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS"]
+                           "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS", "IMPORT_IN_PROGRESS", "IMPORT_ROLLBACK_IN_PROGRESS"]
+# REVIEW_IN_PROGRESS is a stack that only has change sets, waiting for one to be executed, so nothing is running
 StackDoneStatus         = ["CREATE_FAILED", "CREATE_COMPLETE", "ROLLBACK_FAILED", "ROLLBACK_COMPLETE", "DELETE_FAILED",
-                           "DELETE_COMPLETE", "UPDATE_COMPLETE", "UPDATE_ROLLBACK_FAILED", "UPDATE_ROLLBACK_COMPLETE"]
+                           "DELETE_COMPLETE", "UPDATE_COMPLETE", "UPDATE_FAILED", "UPDATE_ROLLBACK_FAILED", "UPDATE_ROLLBACK_COMPLETE",
+                           "IMPORT_COMPLETE", "IMPORT_ROLLBACK_FAILED", "IMPORT_ROLLBACK_COMPLETE", "REVIEW_IN_PROGRESS"]
 StackGoodStatus         = ["CREATE_COMPLETE", "UPDATE_COMPLETE"]
+# Stacks that are in a stable state, so drift detection can run on them
+StackDriftableStatus    = ["CREATE_COMPLETE", "UPDATE_COMPLETE", "UPDATE_ROLLBACK_COMPLETE", "IMPORT_COMPLETE", "IMPORT_ROLLBACK_COMPLETE"]
+DriftDetectionDoneStatus = ["DETECTION_COMPLETE", "DETECTION_FAILED"]
+ChangeSetDoneStatus     = ["CREATE_COMPLETE", "FAILED", "DELETE_COMPLETE", "DELETE_FAILED"]
+
+# The parts of a create_stack / update_stack payload that create_change_set also accepts
+ChangeSetPayloadKeys    = ['StackName', 'TemplateBody', 'TemplateURL', 'Parameters', 'Capabilities', 'Tags']
+
+
+def new_client_request_token():
+    """Return a unique ClientRequestToken. CloudFormation tags every event of a stack operation with its token."""
+    return(f"cft-deploy-{uuid.uuid4()}")
 
 
 class CFStack(object):
     """Class to represent a CloudFormation Template"""
 
-    def __init__(self, stack_name, region, session=None):
-        """Constructs a CFTemplate from the template_body (json or yaml)."""
+    def __init__(self, stack_name, region, session=None, cache=None):
+        """Constructs a CFTemplate from the template_body (json or yaml).
+        If cache (a StackCache) is set, get_cached() and get_resources() will use it."""
         self.stack_name = stack_name
         self.region = region
-        if session is None:
-            self.session = boto3.session.Session()
-        else:
-            self.session = session
+        self.session = get_session(session)
+        self.cache = cache
+        self.from_cache = False
 
-        self.cf_client = self.session.client('cloudformation', region_name=region)
+        self.cf_client = get_client('cloudformation', region, self.session)
 
         # if self.get() is None:
         #     return(None)
@@ -66,11 +85,12 @@ class CFStack(object):
             payload['TimeoutInMinutes'] = TimeoutInMinutes
         if OnFailure is not None:
             payload['OnFailure'] = OnFailure
+        payload['ClientRequestToken'] = self.client_request_token = new_client_request_token()
 
         # Now make the decision on what to tell CF about the template
         if template is not None:
             self.template = template
-            payload['TemplateBody'] = self.template.template_body
+            payload.update(self.template.template_args())
         elif S3Template is not None:
             self.S3Template = S3Template
             payload['TemplateURL'] = self.S3Template
@@ -103,6 +123,7 @@ class CFStack(object):
                 return(None)
             self.stackData = response['Stacks'][0]
             self.__dict__.update(self.stackData)
+            self.from_cache = False
             return(self.StackId)
         except ClientError as e:
             if e.response['Error']['Code'] == "ValidationError":
@@ -110,9 +131,26 @@ class CFStack(object):
             else:
                 raise
 
+    def get_cached(self):
+        """Like get(), but if this stack has a cache with a still valid copy of the stack, use that instead of calling AWS.
+        Only the StackId, StackName, StackStatus, Parameters and Outputs are cached."""
+        if self.cache is not None:
+            value = self.cache.lookup(self)
+            if value is not None:
+                self.stackData = value['StackData']
+                self.__dict__.update(self.stackData)
+                self.cached_resources = value['Resources']
+                self.from_cache = True
+                return(self.StackId)
+        stack_id = self.get()
+        if self.cache is not None and stack_id is not None:
+            self.cache.store(self)
+        return(stack_id)
+
     def delete(self):
         """ Deletes this stack."""
-        self.cf_client.delete_stack(StackName=self.StackId)
+        self.client_request_token = new_client_request_token()
+        self.cf_client.delete_stack(StackName=self.StackId, ClientRequestToken=self.client_request_token)
 
     def update(self, manifest=None, override=None, payload=None):
         """ Updates a Stack based on this manifest."""
@@ -133,6 +171,7 @@ class CFStack(object):
                 del payload['OnFailure']
             if 'EnableTerminationProtection' in payload:
                 del payload['EnableTerminationProtection']
+            payload['ClientRequestToken'] = self.client_request_token = new_client_request_token()
 
             logger.debug(json.dumps(payload, indent=2))
             stack_response = self.cf_client.update_stack(**payload)
@@ -155,11 +194,12 @@ class CFStack(object):
                 logger.error(f"Error attempting to update {self.stack_name} in {self.region}: {e}")
                 return(None)
 
-    def get_parameters(self):
-        """ Return a dict of each parameter to this stack."""
-        self.get()
+    def get_parameters(self, refresh=True):
+        """ Return a dict of each parameter to this stack. If refresh is False, use the data from the last get()."""
+        if refresh or not hasattr(self, 'stackData'):
+            self.get()
         output = {}
-        for p in self.Parameters:
+        for p in self.stackData.get('Parameters', []):
             if 'ResolvedValue' in p:
                 output[p['ParameterKey']] = p['ResolvedValue']
             elif 'ParameterValue' in p:
@@ -168,24 +208,38 @@ class CFStack(object):
                 logger.error(f"No values for {p['ParameterKey']} in get_parameters()")
         return(output)
 
-    def get_outputs(self):
-        """ Return a dict of each output of this stack."""
-        self.get()
+    def get_outputs(self, refresh=True):
+        """ Return a dict of each output of this stack. If refresh is False, use the data from the last get()."""
+        if refresh or not hasattr(self, 'stackData'):
+            self.get()
         output = {}
-        for o in self.Outputs:
+        # Stacks without outputs don't return the Outputs key at all
+        for o in self.stackData.get('Outputs', []):
             if 'OutputValue' in o:
                 output[o['OutputKey']] = o['OutputValue']
             else:
                 logger.error(f"No values for {o['OutputKey']} in get_outputs()")
         return(output)
 
+    def get_tags(self, refresh=True):
+        """ Return a dict of each tag on this stack. If refresh is False, use the data from the last get()."""
+        if refresh or not hasattr(self, 'stackData'):
+            self.get()
+        return({t['Key']: t['Value'] for t in self.stackData.get('Tags', [])})
+
     def get_resources(self):
         """ Return all the PhysicalResourceIds for each LogicalId in the template"""
+        if self.from_cache and self.cached_resources is not None:
+            self.resource_pages = 0
+            return(dict(self.cached_resources))
+
         response = self.cf_client.list_stack_resources(StackName=self.StackId)
         self.resources = response['StackResourceSummaries']
+        self.resource_pages = 1  # Number of list_stack_resources calls it took, for API call accounting
         while "NextToken" in response:
-            response = self.cf_client.list_stack_resources(StackName=self.StackId, NextToken=response[ "NextToken"])
-            self.resources.extend( response['StackResourceSummaries'] )
+            response = self.cf_client.list_stack_resources(StackName=self.StackId, NextToken=response["NextToken"])
+            self.resources.extend(response['StackResourceSummaries'])
+            self.resource_pages += 1
 
         output = {}
         for o in self.resources:
@@ -199,11 +253,35 @@ class CFStack(object):
                 logger.error(f"{o['LogicalResourceId']} is in non-good status {o['ResourceStatus']}")
                 continue
 
+        if self.cache is not None and hasattr(self, 'stackData'):
+            self.cache.store(self, resources=output)
         return(output)
 
-    def detect_drift(self):
-        """ Triggers Drift Detection for this stack."""
-        raise NotImplementedError
+    def detect_drift(self, LogicalResourceIds=None):
+        """ Triggers Drift Detection for this stack. Returns the StackDriftDetectionId, also kept as self.drift_detection_id."""
+        kwargs = {'StackName': self.stack_name}
+        if LogicalResourceIds is not None:
+            kwargs['LogicalResourceIds'] = LogicalResourceIds
+        response = self.cf_client.detect_stack_drift(**kwargs)
+        self.drift_detection_id = response['StackDriftDetectionId']
+        return(self.drift_detection_id)
+
+    def get_drift_detection_status(self, drift_detection_id=None):
+        """ Return the describe_stack_drift_detection_status response for drift_detection_id (by default the last detect_drift())."""
+        if drift_detection_id is None:
+            drift_detection_id = self.drift_detection_id
+        response = self.cf_client.describe_stack_drift_detection_status(StackDriftDetectionId=drift_detection_id)
+        del response['ResponseMetadata']
+        return(response)
+
+    def get_drifted_resources(self, StackResourceDriftStatusFilters=["MODIFIED", "DELETED"]):
+        """ Return the resources of this stack whose drift status is one of StackResourceDriftStatusFilters, as of
+        the last drift detection."""
+        resources = []
+        paginator = self.cf_client.get_paginator('describe_stack_resource_drifts')
+        for page in paginator.paginate(StackName=self.stack_name, StackResourceDriftStatusFilters=StackResourceDriftStatusFilters):
+            resources.extend(page['StackResourceDrifts'])
+        return(resources)
 
     def get_status(self):
         '''Fetch the value of StackStatus from AWS CF API for this stack'''
@@ -211,48 +289,160 @@ class CFStack(object):
         return(self.stackData['StackStatus'])
 
     def get_stack_events(self, last_event_id=None):
-        """ Return all stack events since last_event_id."""
-        events = []
-        response = self.cf_client.describe_stack_events(StackName=self.StackId)
-        # Enabling the following would return all of the stack events since the begining of time.
-        # If we're just doing a tail-f with a short interval, then we don't need to paginate the results.
-        # while 'NextToken' in response:
-        #     for event in response['StackEvents']:
-        #         if last_event_id is not None and event['EventId'] == last_event_id:
-        #             # Abort now and return what we've got.
-        #             events.reverse()
-        #             return(events)
-        #         events.append(event)
-        #     response = self.cf_client.describe_stack_events(StackName=self.StackId, NextToken=response['NextToken'])
-        for event in response['StackEvents']:
-            if last_event_id is not None and event['EventId'] == last_event_id:
-                # Abort now and return what we've got.
-                events.reverse()
-                return(events)
-            events.append(event)
-        events.reverse()
-        return(events)
-
-    def create_changeset(self, changeset_name):
-        """ Trigger the creation of the changeset."""
-        raise NotImplementedError
+        """ Return all stack events since last_event_id, oldest first.
+        If last_event_id is None, only the most recent page of events is returned."""
+        cursor = CFStackEventCursor(self)
+        if last_event_id is not None:
+            cursor.mark_seen([last_event_id])
+        return(cursor.fetch())
+
+    def create_changeset(self, changeset_name, manifest=None, override=None, payload=None, ChangeSetType="UPDATE"):
+        """ Trigger the creation of the changeset, from a manifest or a create_stack/update_stack payload.
+        ChangeSetType is UPDATE, or CREATE for a stack that doesn't exist yet. Returns the change set's Id.
+        A CREATE change set fails the way the payload's OnFailure says to (as its OnStackFailure). There is no
+        TimeoutInMinutes for a change set, so it is ignored with a warning."""
+        if manifest is None and payload is None:
+            logger.error("create_changeset has neither manifest nor payload")
+            return(None)
+        if manifest is not None:
+            manifest.fetch_parameters(override=override)
+            payload = manifest.build_cft_payload()
 
-    def describe_changeset(self, changeset_name):
-        """ Get the details of changes from a previously created changeset."""
-        raise NotImplementedError
+        if ChangeSetType == "CREATE" and 'TimeoutInMinutes' in payload:
+            logger.warning(f"A change set can't set a TimeoutInMinutes, so {self.stack_name} is created without one")
+        on_failure = payload.get('OnFailure')
+
+        # The options only valid for create_stack & update_stack (like the StackPolicyBody) aren't part of a change set
+        payload = {k: v for k, v in payload.items() if k in ChangeSetPayloadKeys}
+        if ChangeSetType == "CREATE" and on_failure is not None:
+            payload['OnStackFailure'] = on_failure
+        payload['StackName'] = self.stack_name
+        payload['ChangeSetName'] = changeset_name
+        payload['ChangeSetType'] = ChangeSetType
+        payload['ClientToken'] = new_client_request_token()
+        logger.info(f"Creating {ChangeSetType} change set {changeset_name} for {self.stack_name} in {self.region}")
+        response = self.cf_client.create_change_set(**payload)
+        self.changeset_name = changeset_name
+        self.changeset_type = ChangeSetType
+        self.changeset_id = response['Id']
+        if 'StackId' in response:
+            self.StackId = response['StackId']
+        return(self.changeset_id)
+
+    def get_changeset_status(self, changeset_name=None):
+        """ Return the Status and StatusReason of a change set (by default the last one created), with a single call."""
+        response = self.cf_client.describe_change_set(StackName=self.stack_name, ChangeSetName=changeset_name or self.changeset_name)
+        return({'Status': response['Status'], 'StatusReason': response.get('StatusReason'), 'ExecutionStatus': response.get('ExecutionStatus')})
+
+    def wait_for_changeset(self, changeset_name=None, min_interval=1, max_interval=10, backoff=1.5, bucket=None):
+        """ Poll the change set until it is created (or fails), backing off while it isn't. Returns its final status."""
+        interval = min_interval
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            status = self.get_changeset_status(changeset_name)
+            if status['Status'] in ChangeSetDoneStatus:
+                return(status)
+            time.sleep(interval)
+            interval = min(max_interval, interval * backoff)
+
+    def describe_changeset(self, changeset_name=None):
+        """ Get the details of changes from a previously created changeset (by default the last one created).
+        Returns the describe_change_set response, with the Changes of every page."""
+        kwargs = {'StackName': self.stack_name, 'ChangeSetName': changeset_name or self.changeset_name}
+        response = self.cf_client.describe_change_set(**kwargs)
+        changes = response.get('Changes', [])
+        while 'NextToken' in response:
+            response = self.cf_client.describe_change_set(NextToken=response['NextToken'], **kwargs)
+            changes.extend(response.get('Changes', []))
+        response['Changes'] = changes
+        response.pop('NextToken', None)
+        response.pop('ResponseMetadata', None)
+        return(response)
 
     def list_changesets(self):
         """ List all active changesets for this stack."""
-        raise NotImplementedError
+        summaries = []
+        response = self.cf_client.list_change_sets(StackName=self.stack_name)
+        summaries.extend(response['Summaries'])
+        while 'NextToken' in response:
+            response = self.cf_client.list_change_sets(StackName=self.stack_name, NextToken=response['NextToken'])
+            summaries.extend(response['Summaries'])
+        return(summaries)
+
+    def execute_changeset(self, changeset_name=None):
+        """ Execute a change set (by default the last one created). Its events are tagged with self.client_request_token."""
+        self.client_request_token = new_client_request_token()
+        self.cf_client.execute_change_set(StackName=self.stack_name, ChangeSetName=changeset_name or self.changeset_name,
+                                          ClientRequestToken=self.client_request_token)
+
+    def delete_changeset(self, changeset_name=None):
+        """ Delete a change set (by default the last one created)."""
+        self.cf_client.delete_change_set(StackName=self.stack_name, ChangeSetName=changeset_name or self.changeset_name)
+
+    @classmethod
+    def changeset_is_empty(cls, status):
+        """ Return True if a change set FAILED only because there was nothing to change."""
+        reason = status.get('StatusReason') or ""
+        return(status['Status'] == "FAILED" and ("didn't contain changes" in reason or "No updates are to be performed" in reason))
+
+    @classmethod
+    def summarize_changes(cls, changes):
+        """ Return the resource changes from describe_changeset() as a list of dicts of LogicalResourceId,
+        PhysicalResourceId, ResourceType, Action (Add, Modify, Remove...), Replacement (True, False or Conditional)
+        and Scope (the parts of the resource that changed)."""
+        output = []
+        for c in changes:
+            if c.get('Type') != "Resource":
+                continue
+            rc = c['ResourceChange']
+            output.append({
+                'LogicalResourceId': rc['LogicalResourceId'],
+                'PhysicalResourceId': rc.get('PhysicalResourceId'),
+                'ResourceType': rc['ResourceType'],
+                'Action': rc['Action'],
+                'Replacement': rc.get('Replacement'),
+                'Scope': rc.get('Scope', []),
+            })
+        return(output)
 
     def get_template(self):
         """ Return as a CFTemplate the current template for this stack."""
         response = self.cf_client.get_template(StackName=self.StackId)
         template_body = response['TemplateBody']
+        if not isinstance(template_body, str):
+            # boto3 returns json templates already parsed
+            template_body = json.dumps(template_body, indent=2)
         return(CFTemplate(template_body, self.region, session=self.session))
 
     @classmethod
-    def find_by_resource(cls, PhysicalResourceId=None, region=None, session=None):
+    def get_many(cls, stack_names, region, session=None, cache=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Fetch many stacks in parallel. Returns a dict of stack_name to CFStack, in the order of stack_names.
+        If any stack doesn't exist, CFStackDoesNotExistError is raised for the first missing stack in stack_names."""
+        stacks = [CFStack(stack_name, region, session=session, cache=cache) for stack_name in stack_names]
+        output = {}
+        for my_stack, stack_id, error in run_concurrently(lambda s: s.get_cached(), stacks, max_workers=max_workers):
+            if error is not None:
+                raise error
+            if stack_id is None:
+                raise CFStackDoesNotExistError(my_stack.stack_name)
+            output[my_stack.stack_name] = my_stack
+        return(output)
+
+    @classmethod
+    def list_stack_names(cls, region, session=None, StackStatusFilter=None):
+        """Return the names of the stacks in region (with a status in StackStatusFilter, if set), from list_stacks."""
+        cf_client = get_client('cloudformation', region, get_session(session))
+        kwargs = {} if StackStatusFilter is None else {'StackStatusFilter': StackStatusFilter}
+        names = []
+        for page in cf_client.get_paginator('list_stacks').paginate(**kwargs):
+            names.extend(s['StackName'] for s in page['StackSummaries'] if s['StackStatus'] != "DELETE_COMPLETE")
+        return(names)
+
+    @classmethod
+    def find_by_resource(cls, PhysicalResourceId=None, region=None, session=None, index=None):
+        """Return the CFStack that owns PhysicalResourceId, or None.
+        If index (a CFStackIndex) is set, the stack's details come from it rather than another describe_stacks."""
 
         if region is None:
             if 'AWS_DEFAULT_REGION' not in os.environ:
@@ -260,9 +450,8 @@ class CFStack(object):
                 exit(1)
             region = os.environ['AWS_DEFAULT_REGION']
 
-        if session is None:
-            session = boto3.session.Session()
-        cf_client = session.client('cloudformation', region_name=region)
+        session = get_session(session)
+        cf_client = get_client('cloudformation', region, session)
 
         try:
             if PhysicalResourceId is None:
@@ -275,15 +464,261 @@ class CFStack(object):
             else:
                 raise
 
-        if 'StackResources' not in response and len(response['StackResources']) == 0:
-            logger.error(f"Unable to find a stack for PhysicalResourceId={PhysicalResourceId} / LogicalResourceId={LogicalResourceId} in {region}")
+        if 'StackResources' not in response or len(response['StackResources']) == 0:
+            logger.error(f"Unable to find a stack for PhysicalResourceId={PhysicalResourceId} in {region}")
             return(None)
 
         stack_name = response['StackResources'][0]['StackName']
-        stack = CFStack(stack_name, region, session=session)
-        stack.get()
+        stack = CFStack(stack_name, region, session=session, cache=index)
+        stack.get_cached()
         return(stack)
 
+    @classmethod
+    def find_by_resources(cls, PhysicalResourceIds, region, session=None, index=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Find the stacks owning many PhysicalResourceIds at once. A generator of dicts of PhysicalResourceId,
+        StackName, StackId and LogicalResourceId, yielded as they are found. See CFStackIndex.find_resources()."""
+        if index is None:
+            from .index import CFStackIndex
+            index = CFStackIndex()
+        return(index.find_resources(PhysicalResourceIds, region, session=session, max_workers=max_workers))
+
+
+class CFStackEventCursor(object):
+    """Incrementally fetches a stack's new events.
+
+    describe_stack_events returns the newest events first, so each fetch pages back only until it reaches an event
+    it has already seen. The first fetch returns just the most recent page rather than the whole stack history.
+    The IDs of the last max_seen events are kept to de-duplicate events that show up again on a later page.
+    """
+
+    def __init__(self, stack, max_seen=1000):
+        self.stack = stack
+        self.seen = set()
+        self.seen_order = collections.deque()
+        self.max_seen = max_seen
+        self.api_calls = 0
+
+    def mark_seen(self, event_ids):
+        """Remember event_ids (oldest first) as already processed, forgetting the oldest IDs beyond max_seen."""
+        for event_id in event_ids:
+            if event_id in self.seen:
+                continue
+            self.seen.add(event_id)
+            self.seen_order.append(event_id)
+            if len(self.seen_order) > self.max_seen:
+                self.seen.discard(self.seen_order.popleft())
+
+    def fetch(self):
+        """Return the events not seen before, oldest first."""
+        first_fetch = len(self.seen) == 0
+        events = []
+        kwargs = {'StackName': self.stack.StackId}
+        while True:
+            response = self.stack.cf_client.describe_stack_events(**kwargs)
+            self.api_calls += 1
+            caught_up = False
+            for event in response['StackEvents']:
+                if event['EventId'] in self.seen:
+                    caught_up = True
+                    break
+                events.append(event)
+            if caught_up or first_fetch or 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        events.reverse()
+        self.mark_seen(e['EventId'] for e in events)
+        return(events)
+
+
+class CFStackWatcher(object):
+    """Tails a stack's events, inferring the stack's status from the stack's own events instead of calling describe_stacks.
+
+    Each poll is usually a single describe_stack_events call (more only when over a page of events arrived).
+    Polling starts every min_interval seconds and backs off (by backoff, up to max_interval) while no new events
+    arrive, such as during a long resource creation.
+    If client_request_token is set, only the events of that stack operation are returned, and only its completion
+    ends the watch. Otherwise the watch ends as soon as the stack is no longer in a StackTempStatus.
+    """
+
+    def __init__(self, stack, client_request_token=None, min_interval=1, max_interval=10, backoff=1.5, bucket=None):
+        """If bucket (a TokenBucket) is set, every poll takes a token from it, so many watchers can share one API call budget."""
+        self.stack = stack
+        self.bucket = bucket
+        self.client_request_token = client_request_token
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.cursor = CFStackEventCursor(stack)
+        self.status = None
+        self.done = False
+
+    def poll(self):
+        """Fetch the events since the last poll, update status and done, and return the new events, oldest first."""
+        if self.bucket is not None:
+            self.bucket.acquire()
+        events = self.cursor.fetch()
+        if len(events) == 0:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+            return(events)
+
+        self.interval = self.min_interval
+        if self.client_request_token is not None:
+            events = [e for e in events if e.get('ClientRequestToken') == self.client_request_token]
+
+        for e in events:
+            # The stack's own events carry the StackStatus
+            if e['ResourceType'] == "AWS::CloudFormation::Stack" and e.get('PhysicalResourceId') == self.stack.StackId:
+                self.status = e['ResourceStatus']
+                self.done = self.status not in StackTempStatus
+        return(events)
+
+    def __iter__(self):
+        """Yield each batch of new events until the stack operation is done."""
+        while True:
+            events = self.poll()
+            if len(events) > 0:
+                yield(events)
+            if self.done:
+                return
+            time.sleep(self.interval)
+
+    def wait(self, on_events=None, on_complete=None):
+        """Watch the stack until the operation is done, calling on_events(stack, events) with each batch of new events
+        and on_complete(stack, status) at the end. Returns the final StackStatus."""
+        for events in self:
+            if on_events is not None:
+                on_events(self.stack, events)
+        if on_complete is not None:
+            on_complete(self.stack, self.status)
+        return(self.status)
+
+
+class CFStackMonitor(object):
+    """Tails the events of many stacks from a single thread.
+
+    Each stack is polled by its CFStackWatcher's own adaptive schedule, but all polls are spread across a
+    global budget of rate describe_stack_events calls per second (with bursts of up to burst calls).
+    """
+
+    def __init__(self, watchers=None, rate=2, burst=4):
+        self.bucket = TokenBucket(rate, burst)
+        self.watchers = []
+        for watcher in watchers or []:
+            self.add(watcher)
+
+    def add(self, watcher):
+        """Add a CFStackWatcher (or a CFStack, which is wrapped in one) to the set of stacks being watched."""
+        if isinstance(watcher, CFStack):
+            watcher = CFStackWatcher(watcher)
+        watcher.bucket = self.bucket
+        self.watchers.append(watcher)
+        return(watcher)
+
+    def run(self, on_events=None, on_complete=None):
+        """Poll every stack until all are done, calling on_events(stack, events) with each batch of new events and
+        on_complete(stack, status) as each stack finishes. Returns a dict of stack_name to final StackStatus."""
+        results = {}
+        # Schedule is a heap of (when to poll next, tie-breaker, watcher)
+        schedule = [(time.monotonic(), i, w) for i, w in enumerate(self.watchers)]
+        heapq.heapify(schedule)
+        while len(schedule) > 0:
+            (due, i, watcher) = heapq.heappop(schedule)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            events = watcher.poll()
+            if len(events) > 0 and on_events is not None:
+                on_events(watcher.stack, events)
+            if watcher.done:
+                results[watcher.stack.stack_name] = watcher.status
+                if on_complete is not None:
+                    on_complete(watcher.stack, watcher.status)
+            else:
+                heapq.heappush(schedule, (time.monotonic() + watcher.interval, i, watcher))
+        return(results)
+
+
+class CFStackDriftMonitor(object):
+    """Runs drift detection on many stacks from a single thread.
+
+    At most max_concurrency detections run at once; as each one finishes, the next stack's detection is started.
+    Each detection's status is polled every min_interval seconds, backing off (by backoff, up to max_interval)
+    while it is still running. All the calls share a budget of rate calls per second (with bursts of up to burst
+    calls), and are retried with backoff when AWS throttles them. A fleet scan takes about as long as the slowest
+    stack, not the sum of all of them.
+    """
+
+    def __init__(self, stacks, max_concurrency=10, rate=2, burst=4, min_interval=2, max_interval=30, backoff=1.5):
+        self.stacks = list(stacks)
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+    def _call(self, func):
+        self.bucket.acquire()
+        return(func())
+
+    def _result(self, stack, status):
+        """Return the result for a stack whose detection has finished."""
+        result = {'StackName': stack.stack_name, 'StackId': status.get('StackId'), 'DetectionStatus': status['DetectionStatus'],
+                  'StackDriftStatus': status.get('StackDriftStatus'), 'DriftedStackResourceCount': status.get('DriftedStackResourceCount', 0)}
+        if 'DetectionStatusReason' in status:
+            result['DetectionStatusReason'] = status['DetectionStatusReason']
+        if status.get('StackDriftStatus') == "DRIFTED":
+            result['DriftedResources'] = [
+                {k: r[k] for k in ['LogicalResourceId', 'PhysicalResourceId', 'ResourceType', 'StackResourceDriftStatus', 'PropertyDifferences'] if k in r}
+                for r in self._call(stack.get_drifted_resources)
+            ]
+        return(result)
+
+    def run(self, on_result=None):
+        """Detect drift on every stack, calling on_result(stack, result) as each stack finishes.
+        Returns a dict of stack_name to result: a dict of StackName, StackId, DetectionStatus, StackDriftStatus,
+        DriftedStackResourceCount and the DriftedResources, or of StackName and Error if the detection couldn't run.
+        """
+        results = {}
+        pending = list(self.stacks)
+        # Schedule is a heap of (when to poll next, tie-breaker, stack, interval)
+        schedule = []
+        counter = 0
+
+        def _finish(stack, result):
+            results[stack.stack_name] = result
+            if on_result is not None:
+                on_result(stack, result)
+
+        while len(pending) > 0 or len(schedule) > 0:
+            # Keep max_concurrency detections running
+            while len(pending) > 0 and len(schedule) < self.max_concurrency:
+                stack = pending.pop(0)
+                try:
+                    self._call(stack.detect_drift)
+                    logger.debug(f"Started drift detection {stack.drift_detection_id} on {stack.stack_name}")
+                    heapq.heappush(schedule, (time.monotonic() + self.min_interval, counter, stack, self.min_interval))
+                    counter += 1
+                except ClientError as e:
+                    _finish(stack, {'StackName': stack.stack_name, 'Error': str(e)})
+            if len(schedule) == 0:
+                continue
+
+            (due, i, stack, interval) = heapq.heappop(schedule)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = self._call(stack.get_drift_detection_status)
+                if status['DetectionStatus'] not in DriftDetectionDoneStatus:
+                    interval = min(self.max_interval, interval * self.backoff)
+                    heapq.heappush(schedule, (time.monotonic() + interval, i, stack, interval))
+                    continue
+                _finish(stack, self._result(stack, status))
+            except ClientError as e:
+                _finish(stack, {'StackName': stack.stack_name, 'Error': str(e)})
+        return(results)
+
 
 class CFStackDoesNotExistError(Exception):
     """Exception to raise when the CF Stack is not found. """
@@ -6,27 +6,143 @@ import sys
 import json
 import yaml
 import datetime
+import hashlib
+import codecs
+import glob
+import io
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+from .clients import get_client, get_session
+from .concurrency import DEFAULT_MAX_WORKERS, run_concurrently
 
 import logging
 logger = logging.getLogger('cft-deploy.template')
 
+# S3 object metadata holding the sha256 of an uploaded template, used to skip uploading it again
+TemplateHashMetadataKey = "cft-deploy-sha256"
+
+TemplateExtensions = [".yaml", ".yml", ".json", ".template"]
+
+# The largest TemplateBody CloudFormation accepts. Larger templates must be passed by TemplateURL
+MaxTemplateBodySize = 51200
+
+# Bucket that oversize local templates are staged to, unless one is given explicitly
+DEFAULT_STAGING_BUCKET = os.getenv('CFT_DEPLOY_STAGING_BUCKET')
+DEFAULT_STAGING_PREFIX = "cft-deploy-staging/"
+
+# Warn when a template passed inline is this fraction of MaxTemplateBodySize or more
+SizeWarningThreshold = 0.9
+
+# Templates are read from disk and S3 this many bytes at a time
+TemplateReadChunkSize = 64 * 1024
+
+
+# Use libyaml's parser when pyyaml was built with it, it's several times faster
+class CFNLoader(getattr(yaml, "CSafeLoader", yaml.SafeLoader)):
+    """yaml Loader for CloudFormation templates.
+
+    The short form intrinsic functions (!Ref, !Sub, !GetAtt etc) are converted to their long form ({"Ref": ...},
+    {"Fn::Sub": ...}). Dates (like the AWSTemplateFormatVersion) are kept as strings, as are numbers that wouldn't
+    be written back out the same way (3.10, 0755, 1e3), so that re-emitting the template as json doesn't change it.
+    """
+
+    def construct_yaml_int(self, node):
+        value = super().construct_yaml_int(node)
+        return(value if str(value) == node.value else node.value)
+
+    def construct_yaml_float(self, node):
+        value = super().construct_yaml_float(node)
+        return(value if repr(value) == node.value else node.value)
+
+
+def construct_cfn_tag(loader, tag_suffix, node):
+    """Return the long form of a CloudFormation short form tag."""
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix in ["Ref", "Condition"]:
+        return({tag_suffix: value})
+    if tag_suffix == "GetAtt" and isinstance(value, str):
+        # !GetAtt Resource.Attribute is the short form of ["Resource", "Attribute"]
+        value = value.split(".", 1)
+    return({f"Fn::{tag_suffix}": value})
+
+
+CFNLoader.add_constructor('tag:yaml.org,2002:int', CFNLoader.construct_yaml_int)
+CFNLoader.add_constructor('tag:yaml.org,2002:float', CFNLoader.construct_yaml_float)
+CFNLoader.add_multi_constructor('!', construct_cfn_tag)
+CFNLoader.yaml_implicit_resolvers = {
+    k: [(tag, regexp) for (tag, regexp) in v if tag != 'tag:yaml.org,2002:timestamp']
+    for k, v in yaml.SafeLoader.yaml_implicit_resolvers.items()
+}
+
+
+def read_chunks(chunks, translate_newlines=False):
+    """Decode an iterable of utf-8 byte chunks as they arrive, hashing the text as it is decoded, so that only the
+    decoded text is ever held in full. If translate_newlines is set, CRLF and CR line endings become LF, as when a
+    file is opened in text mode. Returns the text and its sha256 (hex), the same as CFTemplate.content_hash()."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    if translate_newlines:
+        decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+    digest = hashlib.sha256()
+    parts = []
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        digest.update(text.encode("utf-8"))
+        parts.append(text)
+    text = decoder.decode(b"", final=True)
+    digest.update(text.encode("utf-8"))
+    parts.append(text)
+    return("".join(parts), digest.hexdigest())
+
+
+def read_file(filename):
+    """Read a utf-8 text file in chunks. Returns its text and sha256 (hex), see read_chunks()."""
+    with open(filename, "rb") as f:
+        return(read_chunks(iter(lambda: f.read(TemplateReadChunkSize), b""), translate_newlines=True))
+
+
+def is_json_template(template_body, filename=None):
+    """Return True if the template is json rather than yaml, by its extension or else its content."""
+    if filename is not None and os.path.splitext(filename)[1] in [".json", ".yaml", ".yml"]:
+        return(filename.endswith(".json"))
+    return(template_body.lstrip().startswith("{"))
+
+
+def parse_template(template_body, filename=None):
+    """Parse a template (json, or yaml with CloudFormation short form tags) and return it as a dict."""
+    if is_json_template(template_body, filename):
+        return(json.loads(template_body))
+    return(yaml.load(template_body, Loader=CFNLoader))
+
 
 class CFTemplate(object):
     """Class to represent a CloudFormation Template"""
 
-    def __init__(self, template_body, region, filename=None, s3url=None, session=None):
-        """Constructs a CFTemplate from the template_body (json or yaml)."""
+    def __init__(self, template_body, region, filename=None, s3url=None, session=None, staging_bucket=None, validation_cache=None,
+                 content_hash=None):
+        """Constructs a CFTemplate from the template_body (json or yaml).
+        If the body is too large to pass inline, it is uploaded to staging_bucket (or $CFT_DEPLOY_STAGING_BUCKET)
+        and passed by TemplateURL instead. If validation_cache (a ValidationCache) is set, validate() results are
+        reused while the template is unchanged. content_hash is the body's sha256, if it was already computed."""
         self.template_body = template_body
+        self._content_hash = content_hash
         self.filename = filename
         self.s3url = s3url
+        self.staging_bucket = staging_bucket if staging_bucket is not None else DEFAULT_STAGING_BUCKET
+        self.staged_url = None
+        self.minified_body = None
+        self.always_minify = False  # Set to pass the minified body to CloudFormation even when the template fits as is
+        self.validation_cache = validation_cache
+        self.validation_error = None  # Why CloudFormation rejected the template, set by validate()
 
-        if session is None:
-            self.session = boto3.session.Session()
-        else:
-            self.session = session
+        self.session = get_session(session)
 
-        self.cf_client = self.session.client('cloudformation', region_name=region)
+        self.cf_client = get_client('cloudformation', region, self.session)
         self.region = region
 
     def __str__(self):
@@ -38,36 +154,46 @@ class CFTemplate(object):
             return("A Template has no name")
 
     @classmethod
-    def read(cls, filename, region, session=None):
+    def read(cls, filename, region, session=None, staging_bucket=None, validation_cache=None):
         """Read the template from filename and then initialize."""
-        f = open(filename, "r")
-        template_body = f.read()
-        return(CFTemplate(template_body, region, filename=filename, session=session))
+        (template_body, digest) = read_file(filename)
+        return(CFTemplate(template_body, region, filename=filename, session=session, staging_bucket=staging_bucket,
+                          validation_cache=validation_cache, content_hash=digest))
 
     @classmethod
-    def download(cls, bucket, object_key, region, session=None):
-        """Downloads the template from S3 and then initialize."""
+    def download(cls, bucket, object_key, region, session=None, validation_cache=None, s3_client=None):
+        """Downloads the template from S3 (with s3_client, or the shared client for session) and then initialize."""
         try:
-            s3 = boto3.client('s3')  # FIXME will fail for cross-account roles
+            s3 = s3_client if s3_client is not None else get_client('s3', session=session)
             response = s3.get_object(
                 Bucket=bucket,
                 Key=object_key
             )
-            template_body = response['Body'].read().decode("utf-8")
-            return(CFTemplate(template_body, region, s3url=f"s3://{bucket}/{object_key}", session=session))
+            try:
+                (template_body, digest) = read_chunks(response['Body'].iter_chunks(TemplateReadChunkSize))
+            finally:
+                response['Body'].close()
+            return(CFTemplate(template_body, region, s3url=f"s3://{bucket}/{object_key}", session=session,
+                              validation_cache=validation_cache, content_hash=digest))
         except ClientError as e:
             logger.error("ClientError downloading template: {}".format(e))
             raise
 
     def validate(self):
-        """Validate the template's syntax by sending to CloudFormation Service. Returns json from AWS."""
+        """Validate the template's syntax by sending to CloudFormation Service. Returns json from AWS.
+        Returns None if the template is invalid (with the reason as self.validation_error), and raises
+        CFTemplateTooLargeError without calling AWS if the template can't be passed inline or staged."""
+        if self.validation_cache is not None:
+            response = self.validation_cache.lookup(self)
+            if response is not None:
+                return(response)
+        template_args = self.template_args()
+        if 'TemplateBody' in template_args and len(template_args['TemplateBody'].encode("utf-8")) > MaxTemplateBodySize:
+            raise CFTemplateTooLargeError(f"{self} is over the {MaxTemplateBodySize} byte limit for inline templates")
         try:
-            if self.filename is not None:
-                response = self.cf_client.validate_template(TemplateBody=self.template_body)
-            else:
-                (bucket, object_key) = self.parse_s3_url(self.s3url)
-                template_url = f"https://s3.amazonaws.com/{bucket}/{object_key}"
-                response = self.cf_client.validate_template(TemplateURL=template_url)
+            response = self.cf_client.validate_template(**template_args)
+            if self.validation_cache is not None:
+                self.validation_cache.store(self, response)
             return(response)
         except ClientError as e:
             if e.response['Error']['Code'] == 'ValidationError':
@@ -75,6 +201,7 @@ class CFTemplate(object):
                     raise CFTemplateTooLargeError(e)
                 else:
                     logger.error(f"Invalid Template: {e}")
+                    self.validation_error = e.response['Error']['Message']
                     return(None)
             else:
                 raise
@@ -144,26 +271,197 @@ class CFTemplate(object):
             f.close()
             return(CFManifest(manifest_file_name, self.session))
 
+    def size(self):
+        """Return the size of the template body in bytes."""
+        return(len(self.template_body.encode("utf-8")))
+
+    def is_too_large(self):
+        """Return True if the template is too large to pass to CloudFormation as a TemplateBody."""
+        return(self.size() > MaxTemplateBodySize)
+
+    def parse(self):
+        """Parse the template (json, or yaml with CloudFormation short form tags) and return it as a dict."""
+        return(parse_template(self.template_body, self.filename))
+
+    def lint(self):
+        """Check the template's structure locally, without calling AWS. See lint_template()."""
+        return(lint_body(self.template_body, self.filename))
+
+    def minify(self):
+        """Return the template as compact json, without the comments and whitespace of the original.
+        The result is kept as self.minified_body."""
+        if self.minified_body is None:
+            self.minified_body = json.dumps(self.parse(), separators=(',', ':'), ensure_ascii=False)
+            minified_size = len(self.minified_body.encode("utf-8"))
+            logger.info(f"Minified {self} from {self.size()} to {minified_size} bytes ({minified_size * 100 // max(1, self.size())}%)")
+        return(self.minified_body)
+
+    def check_size(self, body):
+        """Warn if body is close to (or over) the inline limit. Returns its size in bytes."""
+        size = len(body.encode("utf-8"))
+        if size > MaxTemplateBodySize:
+            logger.warning(f"{self} is {size} bytes, over the {MaxTemplateBodySize} byte limit for inline templates")
+        elif size >= MaxTemplateBodySize * SizeWarningThreshold:
+            logger.warning(f"{self} is {size} bytes, close to the {MaxTemplateBodySize} byte limit for inline templates")
+        return(size)
+
+    def inline_body(self):
+        """Return the body to pass as the TemplateBody: the template as is, or minified if that is too large (or
+        always_minify is set). json can be larger than compact yaml, so the smaller of the two is used.
+        Returns None if neither fits."""
+        if not self.is_too_large() and not self.always_minify:
+            self.check_size(self.template_body)
+            return(self.template_body)
+        try:
+            body = min([self.template_body, self.minify()], key=lambda b: len(b.encode("utf-8")))
+        except (ValueError, yaml.YAMLError) as e:
+            logger.error(f"Unable to parse {self} to minify it: {e}")
+            body = self.template_body
+        if self.check_size(body) > MaxTemplateBodySize:
+            return(None)
+        return(body)
+
+    def stage(self, bucket=None, prefix=DEFAULT_STAGING_PREFIX):
+        """Upload the template to bucket (by default the staging bucket) under a key derived from its hash, so each
+        version is only uploaded once. Returns the https url to pass to CloudFormation as the TemplateURL."""
+        bucket = bucket if bucket is not None else self.staging_bucket
+        if self.staged_url is None:
+            object_key = self.content_addressed_key(prefix)
+            logger.info(f"Staging {self} ({len(self.template_body.encode('utf-8'))} bytes) to s3://{bucket}/{object_key}")
+            self.upload(bucket, object_key)
+            self.staged_url = f"https://s3.amazonaws.com/{bucket}/{object_key}"
+        return(self.staged_url)
+
+    def template_args(self):
+        """Return the TemplateBody or TemplateURL arguments to pass this template to CloudFormation.
+        Templates read from S3 are passed by url. Local templates too large to pass as a TemplateBody are minified,
+        and if that isn't enough, staged to S3 if there is a staging bucket. Otherwise CloudFormation will reject
+        them (see CFTemplateTooLargeError).
+        """
+        if self.filename is None and self.s3url is not None:
+            (bucket, object_key) = self.parse_s3_url(self.s3url)
+            return({'TemplateURL': f"https://s3.amazonaws.com/{bucket}/{object_key}"})
+        body = self.inline_body()
+        if body is not None:
+            return({'TemplateBody': body})
+        if self.staging_bucket is not None:
+            return({'TemplateURL': self.stage()})
+        return({'TemplateBody': self.template_body})
+
     def diff(self, other_template):
-        """prints out the differences between this template and another one."""
-        raise NotImplementedError
+        """Return the differences from this template to other_template, as a list of changes from diff_templates().
+        As both templates are parsed, a json and a yaml template (or a reformatted one) only differ in content."""
+        return(diff_templates(self.parse(), other_template.parse()))
+
+    def content_hash(self):
+        """Return the sha256 (hex) of the template body."""
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.template_body.encode("utf-8")).hexdigest()
+        return(self._content_hash)
 
-    def upload(self, bucket, object_key):
-        """Upload the template to S3."""
+    def is_json(self):
+        """Return True if the template is json rather than yaml."""
+        return(is_json_template(self.template_body, self.filename))
+
+    def content_type(self):
+        return("application/json" if self.is_json() else "application/x-yaml")
+
+    def content_addressed_key(self, prefix=""):
+        """Return an object key derived from the template's hash, so a changed template never overwrites an old one."""
+        return(f"{prefix}{self.content_hash()}{'.json' if self.is_json() else '.yaml'}")
+
+    def upload(self, bucket, object_key=None, force=False):
+        """Upload the template to S3, as object_key or if it is None, the content_addressed_key().
+
+        The template's sha256 is stored in the object's metadata. Unless force is set, the upload is skipped if the
+        object already has the same sha256, and self.uploaded is set to False. Returns the template's s3 url.
+        """
+        digest = self.content_hash()
+        if object_key is None:
+            object_key = self.content_addressed_key()
+        s3_client = get_client('s3', session=self.session)
+        self.uploaded = False
         try:
-            s3_client = self.session.client('s3')
-            response = s3_client.put_object(
-                Body=self.template_body,
-                Bucket=bucket,
-                ContentType='application/json',
-                Key=object_key
-            )
+            if not force and self.get_uploaded_hash(bucket, object_key) == digest:
+                logger.debug(f"s3://{bucket}/{object_key} is unchanged. Not uploading")
+            else:
+                s3_client.put_object(
+                    Body=self.template_body,
+                    Bucket=bucket,
+                    ContentType=self.content_type(),
+                    Key=object_key,
+                    Metadata={TemplateHashMetadataKey: digest}
+                )
+                self.uploaded = True
             self.s3url = f"s3://{bucket}/{object_key}"
             return(self.s3url)
         except ClientError as e:
             logger.error("ClientError saving template: {}".format(e))
             raise
 
+    def get_uploaded_hash(self, bucket, object_key):
+        """Return the sha256 stored with the object by upload(), or None if the object (or its metadata) doesn't exist,
+        or we aren't allowed to read it (as head_object needs s3:GetObject, which uploading doesn't)."""
+        s3_client = get_client('s3', session=self.session)
+        try:
+            response = s3_client.head_object(Bucket=bucket, Key=object_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return(None)
+            if e.response['Error']['Code'] in ['403', 'AccessDenied', 'Forbidden']:
+                logger.debug(f"Not allowed to read s3://{bucket}/{object_key}, so it will be uploaded: {e}")
+                return(None)
+            raise
+        return(response.get('Metadata', {}).get(TemplateHashMetadataKey))
+
+    @classmethod
+    def upload_many(cls, uploads, bucket, force=False, max_workers=DEFAULT_MAX_WORKERS):
+        """Upload many templates in parallel. uploads is a list of (CFTemplate, object_key), where object_key may be
+        None for a content addressed key. Returns a list of (CFTemplate, s3url, exception) in the same order."""
+        results = run_concurrently(lambda u: u[0].upload(bucket, u[1], force=force), uploads, max_workers=max_workers)
+        return([(u[0], s3url, e) for u, s3url, e in results])
+
+    @classmethod
+    def find_templates(cls, path):
+        """Return path if it is a file, or the template files under the directory path, sorted. A path with glob
+        wildcards (** matching any number of directories) is expanded, and each match is treated the same way.
+        Files matched by a glob or in a directory without a Resources or AWSTemplateFormatVersion key (like manifests) are skipped."""
+        if any(c in path for c in "*?["):
+            matches = [m for m in glob.glob(path, recursive=True) if os.path.isdir(m) or cls.looks_like_template(m)]
+            return(sorted(set(f for m in matches for f in cls.find_templates(m))))
+        if not os.path.isdir(path):
+            return([path])
+        output = []
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for f in filenames:
+                if os.path.splitext(f)[1] in TemplateExtensions and cls.looks_like_template(os.path.join(dirpath, f)):
+                    output.append(os.path.join(dirpath, f))
+        return(sorted(output))
+
+    @classmethod
+    def looks_like_template(cls, filename):
+        """Return True if the file has a Resources or AWSTemplateFormatVersion key, without parsing it."""
+        try:
+            with open(filename, "r") as f:
+                return(re.search(r"""["']?(Resources|AWSTemplateFormatVersion)["']?\s*:""", f.read()) is not None)
+        except (OSError, UnicodeDecodeError):
+            return(False)
+
+    @classmethod
+    def find_s3_templates(cls, s3url, session=None, s3_client=None):
+        """Return s3url if it is an object, or if it ends in / the urls of the templates (by extension) under that
+        prefix, sorted."""
+        (bucket, prefix) = cls.parse_s3_url(s3url)
+        if bucket is None or not s3url.endswith("/"):
+            return([s3url])
+        s3 = s3_client if s3_client is not None else get_client('s3', session=session)
+        output = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for o in page.get('Contents', []):
+                if os.path.splitext(o['Key'])[1] in TemplateExtensions:
+                    output.append(f"s3://{bucket}/{o['Key']}")
+        return(sorted(output))
+
     @classmethod
     def parse_s3_url(cls, s3url):
         '''Parse an s3url (s3://bucket/object_key) and return the bucket and object_key'''
@@ -182,6 +480,264 @@ class CFTemplate(object):
         return(bucket, object_key)
 
 
+PseudoParameters = ["AWS::AccountId", "AWS::NotificationARNs", "AWS::NoValue", "AWS::Partition", "AWS::Region",
+                    "AWS::StackId", "AWS::StackName", "AWS::URLSuffix"]
+
+
+def _walk_references(value, refs, errors):
+    """Collect the Ref, Fn::GetAtt and Fn::Sub targets in value into refs, a list of (function, name), and the
+    malformed intrinsic functions into errors, a list of messages."""
+    if isinstance(value, list):
+        for v in value:
+            _walk_references(v, refs, errors)
+        return
+    if not isinstance(value, dict):
+        return
+    for k, v in value.items():
+        if k == "Ref" and isinstance(v, str):
+            refs.append(("Ref", v))
+        elif k == "Fn::GetAtt":
+            if isinstance(v, str):
+                v = v.split(".", 1)
+            if isinstance(v, list) and len(v) > 0 and isinstance(v[0], str):
+                refs.append(("Fn::GetAtt", v[0]))
+            _walk_references(v, refs, errors)
+        elif k == "Fn::Sub":
+            if isinstance(v, str):
+                (string, variables) = (v, {})
+            elif isinstance(v, list) and len(v) == 2 and isinstance(v[1], dict):
+                (string, variables) = v
+            else:
+                errors.append("Fn::Sub must be a string, or a list of a string and a mapping of variables")
+                _walk_references(v, refs, errors)
+                continue
+            if isinstance(string, str):
+                # ${Name} and ${Resource.Attribute}, but not the ${!Literal} escape or the Sub's own variables
+                for name in re.findall(r"\$\{([^!}][^}]*)\}", string):
+                    name = name.strip()
+                    if name in variables:
+                        continue
+                    if "." in name and not name.startswith("AWS::"):
+                        refs.append(("Fn::GetAtt", name.split(".", 1)[0]))
+                    else:
+                        refs.append(("Ref", name))
+            else:
+                _walk_references(string, refs, errors)
+            _walk_references(variables, refs, errors)
+        else:
+            _walk_references(v, refs, errors)
+
+
+def _find_cycle(graph):
+    """Return a list of nodes forming a cycle in graph (a dict of node to the nodes it depends on), or None."""
+    # Iterative depth first search, colouring nodes as unvisited (absent), in progress (1) or done (2)
+    state = {}
+    for start in sorted(graph):
+        if start in state:
+            continue
+        path = [start]
+        stack = [iter(sorted(graph[start]))]
+        state[start] = 1
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif node not in graph or state.get(node) == 2:
+                continue
+            elif state.get(node) == 1:
+                return(path[path.index(node):] + [node])
+            else:
+                state[node] = 1
+                path.append(node)
+                stack.append(iter(sorted(graph[node])))
+    return(None)
+
+
+def lint_template(document):
+    """Check a parsed template's structure without calling AWS.
+
+    Checks that the sections and intrinsic functions have the right shape, that every Ref, Fn::GetAtt, Fn::Sub and
+    DependsOn target is declared, that every Parameter is used (by Resources, Outputs, Conditions or Rules), and
+    that there are no circular dependencies between resources. Returns a list of problems, each a dict of
+    Severity (error or warning) and Message. Templates with a Transform may refer to resources the transform
+    creates, so their undeclared references are only warnings.
+    """
+    problems = []
+
+    def _problem(severity, message):
+        problems.append({'Severity': severity, 'Message': message})
+
+    if not isinstance(document, dict):
+        _problem("error", "Template is not a mapping")
+        return(problems)
+    sections = {}
+    for section in ['Parameters', 'Mappings', 'Conditions', 'Rules', 'Resources', 'Outputs']:
+        sections[section] = document.get(section) or {}
+        if not isinstance(sections[section], dict):
+            _problem("error", f"{section} is not a mapping")
+            sections[section] = {}
+    resources = sections['Resources']
+    parameters = sections['Parameters']
+    if len(resources) == 0:
+        _problem("error", "Template has no Resources")
+    missing = "warning" if 'Transform' in document else "error"
+
+    used_parameters = set()
+    graph = {}  # resource -> resources it depends on
+    for section in ['Resources', 'Outputs', 'Conditions', 'Rules']:
+        for name, body in sections[section].items():
+            refs = []
+            errors = []
+            _walk_references(body, refs, errors)
+            for message in errors:
+                _problem("error", f"{section}/{name}: {message}")
+            depends = set()
+            for (function, target) in refs:
+                if function == "Ref" and target in parameters:
+                    used_parameters.add(target)
+                elif function == "Ref" and (target in resources or target in PseudoParameters):
+                    depends.add(target)
+                elif function == "Fn::GetAtt" and target in resources:
+                    depends.add(target)
+                elif function == "Ref":
+                    _problem(missing, f"{section}/{name}: Ref to undeclared Parameter or Resource {target}")
+                else:
+                    _problem(missing, f"{section}/{name}: Fn::GetAtt of undeclared Resource {target}")
+            if section != 'Resources':
+                continue
+            if not isinstance(body, dict):
+                _problem("error", f"Resources/{name}: Resource is not a mapping")
+                body = {}
+            depends_on = body.get('DependsOn', [])
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            if not isinstance(depends_on, list) or not all(isinstance(d, str) for d in depends_on):
+                _problem("error", f"Resources/{name}: DependsOn must be a Resource name or a list of them")
+                depends_on = []
+            for target in depends_on:
+                if target not in resources:
+                    _problem(missing, f"Resources/{name}: DependsOn undeclared Resource {target}")
+                else:
+                    depends.add(target)
+            graph[name] = set(d for d in depends if d in resources)
+
+    for name in parameters:
+        if name not in used_parameters:
+            _problem("warning", f"Parameters/{name}: Parameter is never used")
+
+    cycle = _find_cycle(graph)
+    if cycle is not None:
+        _problem("error", f"Circular dependency between resources: {' -> '.join(cycle)}")
+    return(problems)
+
+
+def lint_body(template_body, filename=None):
+    """Parse and lint a template body. Returns the problems found by lint_template()."""
+    try:
+        document = parse_template(template_body, filename)
+    except (ValueError, yaml.YAMLError) as e:
+        return([{'Severity': "error", 'Message': f"Unable to parse template: {e}"}])
+    return(lint_template(document))
+
+
+def lint_file(filename):
+    """Read and lint the template in filename. Returns the problems found by lint_template()."""
+    return(lint_body(read_file(filename)[0], filename))
+
+
+def lint_many(filenames, max_workers=None):
+    """Lint many template files, in parallel processes. Returns a dict of filename to problems, in the order of filenames."""
+    filenames = list(filenames)
+    if len(filenames) <= 1 or max_workers == 1:
+        return({f: lint_file(f) for f in filenames})
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return(dict(zip(filenames, executor.map(lint_file, filenames, chunksize=8))))
+
+
+# The sections of a template diff_templates() compares by logical id. Other top level keys are compared as a whole
+DiffSections = ["Parameters", "Mappings", "Conditions", "Resources", "Outputs"]
+
+
+def tree_hash(value):
+    """Return a hash of a parsed template subtree that doesn't depend on key order."""
+    return(hashlib.sha256(json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode("utf-8")).digest())
+
+
+def _diff_values(old, new, path, changes, base):
+    """Append a change to changes for each path under which old and new differ."""
+    if old == new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k in old:
+            if k not in new:
+                changes.append(dict(base, Change="Removed", Path=path + [k], Old=old[k]))
+            else:
+                _diff_values(old[k], new[k], path + [k], changes, base)
+        for k in new:
+            if k not in old:
+                changes.append(dict(base, Change="Added", Path=path + [k], New=new[k]))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i, (o, n) in enumerate(zip(old, new)):
+            _diff_values(o, n, path + [i], changes, base)
+    else:
+        changes.append(dict(base, Change="Modified", Path=path, Old=old, New=new))
+
+
+def diff_templates(old, new):
+    """Compare two parsed templates. Returns a list of changes, each a dict of Change (Added, Removed or Modified),
+    Section, LogicalId, Path (the keys below the logical id) and the Old and/or New values.
+
+    Each logical id is compared by the hash of its subtree first, so unchanged ones are skipped without walking them.
+    A section that isn't a mapping is compared as a whole. Raises ValueError if either template isn't a mapping.
+    """
+    for name, document in [("old", old), ("new", new)]:
+        if not isinstance(document, dict):
+            raise ValueError(f"The {name} template is not a mapping")
+    changes = []
+    for section in DiffSections:
+        old_items = old.get(section) or {}
+        new_items = new.get(section) or {}
+        if not isinstance(old_items, dict) or not isinstance(new_items, dict):
+            if old_items != new_items:
+                changes.append({'Change': "Modified", 'Section': section, 'LogicalId': None, 'Path': [], 'Old': old_items, 'New': new_items})
+            continue
+        for logical_id, value in old_items.items():
+            if logical_id not in new_items:
+                changes.append({'Change': "Removed", 'Section': section, 'LogicalId': logical_id, 'Path': [], 'Old': value})
+            elif tree_hash(value) != tree_hash(new_items[logical_id]):
+                _diff_values(value, new_items[logical_id], [], changes, {'Section': section, 'LogicalId': logical_id})
+        for logical_id, value in new_items.items():
+            if logical_id not in old_items:
+                changes.append({'Change': "Added", 'Section': section, 'LogicalId': logical_id, 'Path': [], 'New': value})
+
+    for key in sorted(set(old) | set(new)):
+        if key in DiffSections or old.get(key) == new.get(key):
+            continue
+        if key not in new:
+            changes.append({'Change': "Removed", 'Section': key, 'LogicalId': None, 'Path': [], 'Old': old[key]})
+        elif key not in old:
+            changes.append({'Change': "Added", 'Section': key, 'LogicalId': None, 'Path': [], 'New': new[key]})
+        else:
+            changes.append({'Change': "Modified", 'Section': key, 'LogicalId': None, 'Path': [], 'Old': old[key], 'New': new[key]})
+    return(changes)
+
+
+def format_changes(changes):
+    """Return a line of text for each change from diff_templates()."""
+    lines = []
+    for c in changes:
+        name = c['Section'] if c['LogicalId'] is None else f"{c['Section']}/{c['LogicalId']}"
+        path = "".join(f"[{p}]" if isinstance(p, int) else f".{p}" for p in c['Path'])
+        if c['Change'] == "Added":
+            lines.append(f"+ {name}{path}: {json.dumps(c['New'], default=str)}")
+        elif c['Change'] == "Removed":
+            lines.append(f"- {name}{path}: {json.dumps(c['Old'], default=str)}")
+        else:
+            lines.append(f"~ {name}{path}: {json.dumps(c['Old'], default=str)} -> {json.dumps(c['New'], default=str)}")
+    return(lines)
+
+
 class CFTemplateTooLargeError(Exception):
     """
     Exception to raise when the CFT cannot be passed to the AWS Service via API
@@ -17,16 +17,17 @@ setup(
   packages=find_packages(),
   py_modules=['cftdeploy'],
   url='http://github.com/jchrisfarris/cft-deploy',
-  python_requires='>=3.6',
+  python_requires='>=3.7',
   include_package_data=True,
   install_requires=[
-    'boto3 >= 1.10.0',
-    'botocore >= 1.13.0',
+    'boto3 >= 1.12.0',
+    'botocore >= 1.15.0',
     'pyyaml',
   ],
   entry_points={
     'console_scripts': [
       "cft-deploy = cftdeploy:cft_deploy",
+      "cft-deploy-many = cftdeploy:cft_deploy_many",
       "cft-get-resource = cftdeploy:cft_get_resource",
       "cft-validate = cftdeploy:cft_validate",
       "cft-validate-manifest = cftdeploy:cft_validate_manifest",
@@ -36,6 +37,10 @@ setup(
       "cft-get-events = cftdeploy:cft_get_events",
       "cft-diff = cftdeploy:cft_diff",
       "cft-get-output = cftdeploy:cft_get_output",
+      "cft-purge-cache = cftdeploy:cft_purge_cache",
+      "cft-find-stack = cftdeploy:cft_find_stack",
+      "cft-drift = cftdeploy:cft_drift",
+      "cft-preview = cftdeploy:cft_preview",
     ]
   }
 )
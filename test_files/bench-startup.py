@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Measures how long each console_script in setup.py takes to start, by timing `<script> --version` in a fresh
+# interpreter, and reports whether boto3 or yaml were imported along the way.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description="Benchmark the startup time of the cft-deploy console_scripts")
+parser.add_argument("--runs", help="Number of runs per script. The fastest is reported", type=int, default=5)
+parser.add_argument("--args", help="Arguments to call each script with", default="--version")
+args = parser.parse_args()
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+with open(os.path.join(repo_dir, "setup.py"), "r") as f:
+    scripts = re.findall(r'"([\w-]+)\s*=\s*cftdeploy:(\w+)"', f.read())
+
+print(f"{'script':<24} {'best (ms)':>10} {'boto3':>6} {'yaml':>6}")
+for script, function in scripts:
+    code = f"import sys; sys.argv = [{script!r}] + {args.args.split()!r}; import cftdeploy; cftdeploy.{function}()"
+    best = None
+    for i in range(args.runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=repo_dir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    imported = re.findall(r"\|\s+(\S+)$", result.stderr, re.MULTILINE)
+    print(f"{script:<24} {best:>10.1f} {'yes' if 'boto3' in imported else 'no':>6} {'yes' if 'yaml' in imported else 'no':>6}")